@@ -0,0 +1,86 @@
+'''
+Approximate nearest neighbour indexes over the compact index vectors, for knowledge bases too large
+for an exact scan. They only pick the candidates: CompactIndex re-scores them with the exact squared L2
+distance of the float32 vectors, so distances, and the relevance threshold, mean the same whatever the type.
+They make searches faster, not smaller: the float32 vectors stay on disk and are read for re-scoring,
+every ANN index is stored on top of them.
+
+    flat     exact scan of the float32 vectors, no ANN index (default)
+    float16  scan of float16 copies, half the vectors' size again on top
+    ivf      inverted lists over k-means clusters, only ANN_NPROBE clusters are scanned
+    hnsw     graph search, fastest queries, the largest index
+    pq       inverted lists of product-quantized codes, the smallest index, a few bytes per vector
+'''
+import math
+import os
+import uuid
+
+import numpy as np
+
+INDEX_TYPES = ("flat", "float16", "ivf", "hnsw", "pq")
+
+# below this many rows the exact scan is fast enough, and IVF/PQ have too few points to train on
+MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "10000"))
+# candidates fetched per result, re-scored exactly
+REFINE = int(os.getenv("ANN_REFINE", "4"))
+# clusters scanned per query by ivf and pq
+NPROBE = int(os.getenv("ANN_NPROBE", "16"))
+# candidate list size of the hnsw graph search
+EF_SEARCH = int(os.getenv("ANN_EF_SEARCH", "64"))
+
+def factory_string(index_type: str, rows: int, dim: int):
+    '''
+    faiss index_factory description of the index type for rows x dim vectors.
+    '''
+    # about 4 sqrt(n) clusters, with the 39 training points per cluster faiss asks for
+    nlist = max(1, min(int(4 * math.sqrt(rows)), rows // 39))
+    if index_type == "float16":
+        return "SQfp16"
+    if index_type == "ivf":
+        return f"IVF{nlist},Flat"
+    if index_type == "hnsw":
+        return "HNSW32"
+    if index_type == "pq":
+        # one byte per 16 dimensions (96 bytes for 1536-dim embeddings), m must divide dim
+        m = next(m for m in range(max(1, dim // 16), 0, -1) if dim % m == 0)
+        return f"IVF{nlist},PQ{m}"
+    raise ValueError(f"unknown index type: {index_type}")
+
+def ann_path(path: str, index_type: str):
+    return os.path.join(path, f"ann_{index_type}.faiss")
+
+def build(path: str, vectors, index_type: str):
+    '''
+    Train and fill the ANN index of the vectors, saved next to them in the compact index directory.
+    Written aside and renamed into place, concurrent builders of the same index each write a complete file.
+    '''
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = faiss.index_factory(vectors.shape[1], factory_string(index_type, len(vectors), vectors.shape[1]), faiss.METRIC_L2)
+    if not index.is_trained:
+        # a sample is enough to place the clusters and codebooks
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), min(len(vectors), 256 * 256), replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    tmp_path = f"{ann_path(path, index_type)}.tmp-{uuid.uuid4().hex[:8]}"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, ann_path(path, index_type))
+    return index
+
+def load(path: str, index_type: str):
+    '''
+    The saved ANN index of this type, written by build.
+    '''
+    import faiss
+
+    return faiss.read_index(ann_path(path, index_type))
+
+def search_params(index_type: str, k: int):
+    import faiss
+
+    if index_type in ("ivf", "pq"):
+        return faiss.SearchParametersIVF(nprobe=NPROBE)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=max(EF_SEARCH, k))
+    return None
@@ -0,0 +1,1058 @@
+'''
+Offline benchmarks for the chatbot components.
+Run from the repository root, e.g. `python app/benchmarks.py bookings`
+'''
+import asyncio
+import contextlib
+import datetime
+import io
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from booking import Booking
+from booking import Bookings
+from booking import SqliteStore
+from booking import WEEKDAY_SLOTS
+from intent import IntentClassifier
+from slots import SlotFiller
+from cache import normalize_text
+import hashlib
+import json
+import llm
+import shutil
+
+
+def write_synthetic_bookings(path: str, rows: int, seed: int = 0):
+    '''
+    Write a bookings csv with `rows` random bookings spread over the past years.
+    '''
+    rng = random.Random(seed)
+    start = datetime.date(2015, 1, 1)
+    days = 365 * 10
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("name,date,time,remarks\n")
+        for i in range(rows):
+            date = start + datetime.timedelta(days=rng.randrange(days))
+            f.write(f"Patient {i},{date.isoformat()},{rng.choice([9, 10, 11, 13, 14, 15, 16])},check up\n")
+
+
+def bench_bookings(rows: int = 1_000_000, lookups: int = 1000):
+    '''
+    Compare the per-date occupancy index against a linear scan of the booking history.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bookings.csv")
+        write_synthetic_bookings(path, rows)
+
+        start = time.perf_counter()
+        bookings = Bookings(path)
+        load_time = time.perf_counter() - start
+
+    rng = random.Random(1)
+    dates = [(datetime.date(2015, 1, 1) + datetime.timedelta(days=rng.randrange(3650))).isoformat() for _ in range(lookups)]
+
+    start = time.perf_counter()
+    for date in dates:
+        bookings.get_available_slots(date)
+    indexed = (time.perf_counter() - start) / lookups
+
+    # linear scan as done before the index, on a sample of the lookups
+    scan_lookups = dates[:10]
+    start = time.perf_counter()
+    for date in scan_lookups:
+        taken = {int(b['time']) for b in bookings.bookings if b['date'] == date}
+        [slot for slot in [9, 10, 11, 13, 14, 15, 16] if slot not in taken]
+    scan = (time.perf_counter() - start) / len(scan_lookups)
+
+    print(f"rows: {rows}")
+    print(f"load + index build: {load_time:.2f}s")
+    print(f"get_available_slots (indexed): {indexed * 1e6:.1f} us/lookup")
+    print(f"linear scan:                   {scan * 1e6:.1f} us/lookup")
+
+
+def bench_next_slots(rows: int = 15_000, queries: int = 1000, full_days: int = 90):
+    '''
+    Next free slots from a date, with the last `full_days` before the search start fully booked,
+    against asking get_available_slots day by day as the chat did before.
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bookings.csv")
+        write_synthetic_bookings(path, rows)
+        bookings = Bookings(path)
+    # a fully booked stretch the search has to cross
+    full_start = datetime.date(2030, 1, 1)
+    for day in range(full_days):
+        date = (full_start + datetime.timedelta(days=day)).isoformat()
+        for hour in WEEKDAY_SLOTS:
+            bookings.add_booking(Booking("Patient", date, hour))
+
+    rng = random.Random(2)
+    starts = [datetime.date(2015, 1, 1) + datetime.timedelta(days=rng.randrange(3650)) for _ in range(queries)]
+    start = time.perf_counter()
+    for date in starts:
+        bookings.next_available_slots(date, 3, per_day=1)
+    random_time = (time.perf_counter() - start) / queries
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        slots = bookings.next_available_slots(full_start, 3, per_day=1)
+    full_time = (time.perf_counter() - start) / queries
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        day_by_day = []
+        date = full_start
+        while len(day_by_day) < 3:
+            avail = bookings.get_available_slots(date.isoformat())
+            if avail:
+                day_by_day.append((date.isoformat(), avail[0]))
+            date += datetime.timedelta(days=1)
+    scan_time = (time.perf_counter() - start) / queries
+
+    print(f"rows: {rows + full_days * len(WEEKDAY_SLOTS)}, queries: {queries}")
+    for label, seconds in [
+        ("next_available_slots, random start", random_time),
+        (f"next_available_slots, {full_days} full days ahead", full_time),
+        ("get_available_slots day by day, same search", scan_time),
+    ]:
+        print(f"{label + ':':<46}{seconds * 1e6:.1f} us/query")
+    print(f"same slots: {slots == day_by_day}, first offer: {slots[0]}")
+
+def _reserve_worker(args):
+    db_path, worker, attempts, dates = args
+    bookings = Bookings(store=SqliteStore(db_path))
+    rng = random.Random(worker)
+    reserved = 0
+    for i in range(attempts):
+        booking = Booking(f"Worker {worker} #{i}", rng.choice(dates), rng.choice([9, 10, 11, 13, 14, 15, 16]))
+        if bookings.reserve_slot(booking):
+            reserved += 1
+    return reserved
+
+def bench_sqlite(workers: int = 8, attempts: int = 500, days: int = 400):
+    '''
+    Concurrent reservations from several worker processes against one SQLite store.
+    '''
+    # weekdays only, so every date has the full weekday template
+    dates = []
+    date = datetime.date(2030, 1, 1)
+    while len(dates) < days:
+        if date.weekday() < 5:
+            dates.append(date.isoformat())
+        date += datetime.timedelta(days=1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bookings.db")
+        store = SqliteStore(db_path)
+        start = time.perf_counter()
+        with multiprocessing.Pool(workers) as pool:
+            reserved = sum(pool.map(_reserve_worker, [(db_path, w, attempts, dates) for w in range(workers)]))
+        elapsed = time.perf_counter() - start
+        rows = store.count()
+        distinct = store.connection().execute("SELECT COUNT(DISTINCT date || ' ' || time) FROM bookings").fetchone()[0]
+        store.connection().close()
+
+    total = workers * attempts
+    print(f"workers: {workers}, attempts: {total}, slots: {days * 7}")
+    print(f"reserved: {reserved}, rejected: {total - reserved}")
+    print(f"throughput: {total / elapsed:.0f} attempts/s ({elapsed:.2f}s, includes worker startup)")
+    print(f"double bookings: {rows - distinct}, rows match reservations: {rows == reserved}")
+
+
+# labeled booking-ish utterances, (text, wants to book)
+INTENT_CORPUS = [
+    ("I want to book an appointment", True),
+    ("I'd like to book a check up next week", True),
+    ("Can I book for tomorrow?", True),
+    ("book me in for friday", True),
+    ("How do I book an appointment?", True),
+    ("I would like an appointment please", True),
+    ("Schedule an appointment for Tommy", True),
+    ("could you schedule me for teeth whitening", True),
+    ("I need to make an appointment", True),
+    ("please book a cleaning for monday", True),
+    ("yes", True),
+    ("I don't want to book anything", False),
+    ("not looking to book right now", False),
+    ("how long does an appointment take?", False),
+    ("what should I bring to my appointment", False),
+    ("do I need to book in advance for braces consultation", False),
+    ("I want to cancel my appointment", False),
+    ("when is the earliest appointment on saturday", False),
+    ("is there parking for appointments", False),
+    ("I need to reschedule my appointment", False),
+    ("I'm not sure, can I book for Monday?", True),
+    ("How do I make an appointment?", True),
+    ("I don't need an appointment", False),
+    ("How can I get to the clinic for my appointment?", False),
+    ("Can I make changes to my booking?", False),
+    ("Can I get my appointment moved to Friday?", False),
+]
+
+def bench_intent(repeat: int = 1000):
+    '''
+    Latency, accuracy and fallback rate of the local intent classifier on a labeled corpus.
+    '''
+    classifier = IntentClassifier()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text, _ in INTENT_CORPUS:
+            classifier.classify(text)
+    per_call = (time.perf_counter() - start) / (repeat * len(INTENT_CORPUS))
+
+    correct = 0
+    for text, expected in INTENT_CORPUS:
+        # the fallback stands in for the LLM and is assumed to be right
+        correct += classifier.check(text, lambda t, expected=expected: expected) == expected
+    stats = classifier.stats()
+    print(f"utterances: {len(INTENT_CORPUS)}")
+    print(f"classify: {per_call * 1e6:.1f} us/call")
+    print(f"decided locally: {stats['local']}, fallback: {stats['fallback']} ({stats['fallback_rate']:.0%})")
+    print(f"accuracy with fallback: {correct / len(INTENT_CORPUS):.0%}")
+
+
+# booking inputs as typed by patients, (text, slots asked for, expected details), None where the LLM is needed
+PARSING_CORPUS = [
+    ("I'm Tommy, I want a booking for tomorrow", ["name", "date"], {"name": "Tommy", "date": "2025-06-03"}),
+    ("Johnny for 6th June", ["name", "date"], None),
+    ("Sarah, 3/6", ["name", "date"], None),
+    ("my name is Anna Lee, next friday please", ["name", "date"], {"name": "Anna Lee", "date": "2025-06-06"}),
+    ("Tommy, next Tuesday at 3pm", ["name", "date"], None),
+    ("my name is Tommy, next Tuesday at 3pm", ["name", "date"], {"name": "Tommy", "date": "2025-06-03", "time": 15}),
+    ("hi, it's Ben", ["name", "date"], {"name": "Ben"}),
+    ("Tommy", ["name", "date"], {"name": "Tommy"}),
+    ("tomorrow", ["name", "date"], {"date": "2025-06-03"}),
+    ("How about Monday", ["name", "date"], {"date": "2025-06-09"}),
+    ("Tomorrow if possible", ["name", "date"], {"date": "2025-06-03"}),
+    ("I'd like to book for next friday", ["name", "date"], {"date": "2025-06-06"}),
+    ("Maybe wednesday", ["name", "date"], {"date": "2025-06-04"}),
+    ("Sometime tomorrow", ["name", "date"], {"date": "2025-06-03"}),
+    ("Whenever, monday", ["name", "date"], {"date": "2025-06-09"}),
+    ("today at 3pm", ["name", "date"], None),
+    ("Tommy", ["name"], {"name": "Tommy"}),
+    ("my name is Sarah Connor", ["name"], {"name": "Sarah Connor"}),
+    ("it's uh, Mike", ["name"], None),
+    ("2025-06-10", ["date"], {"date": "2025-06-10"}),
+    ("03/06", ["date"], {"date": "2025-06-03"}),
+    ("next Friday", ["date"], {"date": "2025-06-06"}),
+    ("this saturday", ["date"], {"date": "2025-06-07"}),
+    ("the 15th", ["date"], {"date": "2025-06-15"}),
+    ("in 3 days", ["date"], {"date": "2025-06-05"}),
+    ("June 20th", ["date"], {"date": "2025-06-20"}),
+    ("today", ["date"], None),
+    ("sometime next week", ["date"], None),
+    ("2pm", ["time"], {"time": 14}),
+    ("14", ["time"], {"time": 14}),
+    ("10 am", ["time"], {"time": 10}),
+    ("at 3 please", ["time"], {"time": 15}),
+    ("4 PM", ["time"], {"time": 16}),
+    ("11:00 a.m.", ["time"], {"time": 11}),
+    ("the earliest one", ["time"], None),
+    ("half past two", ["time"], None),
+    # negated, compared or excluded details are left to the LLM
+    ("not 3pm", ["time"], None),
+    ("no, not at 3pm", ["time"], None),
+    ("not monday", ["date"], None),
+    ("before friday", ["date"], None),
+    ("I'm at work monday", ["name", "date"], None),
+    ("I'm busy tomorrow", ["date"], None),
+    ("I'm thinking friday", ["date"], {"date": "2025-06-06"}),
+    ("Hello there, I'm Tommy", ["name", "date"], None),
+]
+
+def bench_parsing(repeat: int = 1000):
+    '''
+    Share of booking inputs the slot filler resolves without an LLM call, and local parse latency.
+    Every local parse is checked against the expected one, a wrong parse is not an LLM call saved.
+    '''
+    today = datetime.date(2025, 6, 2)
+    filler = SlotFiller()
+    resolved = 0
+    for text, expecting, expected in PARSING_CORPUS:
+        result = filler.parse_locally(text, today, expecting)
+        assert result == expected, (text, result, expected)
+        resolved += result is not None
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text, expecting, _ in PARSING_CORPUS:
+            filler.parse_locally(text, today, expecting)
+    per_call = (time.perf_counter() - start) / (repeat * len(PARSING_CORPUS))
+
+    fallbacks = len(PARSING_CORPUS) - resolved
+    print(f"inputs: {len(PARSING_CORPUS)}")
+    print(f"resolved locally: {resolved}, LLM calls needed: {fallbacks} ({fallbacks / len(PARSING_CORPUS):.0%})")
+    print(f"local parse: {per_call * 1e6:.1f} us/input")
+
+
+# booking conversations as (user input, slots asked for), ending with every slot filled
+SLOT_CONVERSATIONS = [
+    [("Tommy, next Tuesday at 3pm", ["name", "date"])],
+    [("I'm Anna, I want a booking for tomorrow", ["name", "date"]), ("2pm", ["time"])],
+    [("Johnny for 6th June", ["name", "date"]), ("the earliest one", ["time"]), ("9", ["time"])],
+    [("hello", ["name", "date"]), ("Ben, sometime next week, Wednesday works", ["name", "date"]), ("at 11", ["time"])],
+    [("it's uh, Mike, in two weeks at ten", ["name", "date"])],
+]
+# recorded extraction responses for the inputs the local parser cannot resolve
+SLOT_RECORDED = {
+    "Tommy, next Tuesday at 3pm": {"name": "Tommy", "date": "2025-06-03", "time": 15},
+    "Johnny for 6th June": {"name": "Johnny", "date": "2025-06-06", "time": None},
+    "the earliest one": {"name": None, "date": None, "time": None},
+    "hello": {"name": None, "date": None, "time": None},
+    "Ben, sometime next week, Wednesday works": {"name": "Ben", "date": "2025-06-11", "time": None},
+    "it's uh, Mike, in two weeks at ten": {"name": "Mike", "date": "2025-06-16", "time": 10},
+}
+
+def _recorded_slots(messages):
+    text = messages[-1]["content"].split('User input: "')[1].rsplit('"', 1)[0]
+    return json.dumps(SLOT_RECORDED[text])
+
+def bench_slots(latency: float = 0.3):
+    '''
+    LLM calls and wall-clock time per completed booking with the slot filler, against a stub LLM.
+    '''
+    llm.set_client(llm.LLMClient(llm.StubBackend(_recorded_slots, latency=latency)))
+    filler = SlotFiller()
+    today = datetime.date(2025, 6, 2)
+    for conversation in SLOT_CONVERSATIONS:
+        slots = filler.new_booking(today)
+        for text, expecting in conversation:
+            filler.fill(text, slots, expecting)
+        assert not slots.missing(), (conversation, slots.missing())
+        filler.complete(slots)
+    stats = filler.stats()
+    llm.set_client(None)
+    print(f"bookings: {stats['bookings']}, stub LLM latency: {latency * 1000:.0f} ms")
+    print(f"turns per booking: {stats['turns_per_booking']:.1f}")
+    print(f"LLM calls per booking: {stats['llm_calls_per_booking']:.1f}")
+    print(f"extraction time per booking: {stats['extract_seconds_per_booking'] * 1000:.1f} ms")
+
+
+class StubStore:
+    '''
+    Stands in for VectorStore, every query gets the same relevant answer.
+    '''
+    version = "stub"
+
+    def retrieve_scored(self, query, top_k=5, threshold=0.8):
+        return [("We are open from 9 AM to 5 PM on weekdays and 10 AM to 2 PM on Saturdays.", 0.3)]
+
+    def refresh(self):
+        return False
+
+def _session_script(i: int, dates: list):
+    # a question, then a full booking of a distinct slot
+    hours = ["9", "10", "11", "1pm", "2pm", "3pm", "4pm"]
+    name = "Pat " + "".join(chr(ord("a") + int(d)) for d in str(i)).title()
+    date = datetime.date.fromisoformat(dates[i // 7])
+    return [
+        f"What are your opening hours for visit {i}?",
+        "I want to book an appointment",
+        f"my name is {name}, {date.day}/{date.month}/{date.year}",
+        hours[i % 7],
+        "no remarks",
+        "yes",
+    ]
+
+async def _post(reader, writer, payload: dict):
+    body = json.dumps(payload).encode()
+    writer.write(f"POST /chat HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    headers = await reader.readuntil(b"\r\n\r\n")
+    length = int([h for h in headers.decode().split("\r\n") if h.lower().startswith("content-length")][0].split(":")[1])
+    return json.loads(await reader.readexactly(length))
+
+async def _run_sessions(server, port: int, sessions: int, dates: list):
+    from server import serve
+    server_task = asyncio.create_task(serve(server, "127.0.0.1", port, threads=sessions))
+    await asyncio.sleep(0.2)
+    latencies = []
+    confirmed = 0
+
+    async def session(i):
+        nonlocal confirmed
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        session_id = (await _post(reader, writer, {}))["session"]
+        for message in _session_script(i, dates):
+            start = time.perf_counter()
+            reply = await _post(reader, writer, {"session": session_id, "message": message})
+            latencies.append(time.perf_counter() - start)
+        confirmed += any("successfully made" in r for r in reply["replies"])
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(i) for i in range(sessions)))
+    elapsed = time.perf_counter() - start
+    server_task.cancel()
+    return latencies, confirmed, elapsed
+
+def bench_server(sessions: int = 300, latency: float = 0.2, port: int = 8765):
+    '''
+    Load test of the asyncio chat server: concurrent sessions each asking a question and booking a slot.
+    '''
+    from server import ChatServer
+
+    llm.set_client(llm.LLMClient(llm.StubBackend(lambda m: "We are open 9 AM to 5 PM.", latency=latency), max_concurrency=sessions))
+    dates = []
+    date = datetime.date(2030, 1, 1)
+    while len(dates) < sessions // 7 + 1:
+        if date.weekday() < 5:
+            dates.append(date.isoformat())
+        date += datetime.timedelta(days=1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bookings.csv")
+        shutil.copy("bookings_sample.csv", path)
+        bookings = Bookings(path, journal=True)
+        server = ChatServer(bookings, StubStore())
+        latencies, confirmed, elapsed = asyncio.run(_run_sessions(server, port, sessions, dates))
+        calls = llm.get_client().calls
+    llm.set_client(None)
+
+    latencies.sort()
+    turns = len(latencies)
+    print(f"sessions: {sessions}, turns: {turns}, stub LLM latency: {latency * 1000:.0f} ms")
+    print(f"elapsed: {elapsed:.2f}s, throughput: {turns / elapsed:.0f} turns/s")
+    print(f"turn latency p50: {latencies[turns // 2] * 1000:.1f} ms, p95: {latencies[int(turns * 0.95)] * 1000:.1f} ms")
+    print(f"bookings confirmed: {confirmed}/{sessions}, LLM calls: {calls}")
+
+
+def bench_streaming(turns: int = 10, latency: float = 0.3, token_delay: float = 0.02):
+    '''
+    Time to first token of streamed RAG answers against the full generation time, with a stub LLM.
+    '''
+    import main
+
+    answer = "We are open from 9 AM to 5 PM on weekdays and from 10 AM to 2 PM on Saturdays, closed on Sundays."
+    llm.set_client(llm.LLMClient(llm.StubBackend(lambda m: answer, latency=latency, token_delay=token_delay)))
+    store = StubStore()
+    main.response_timings.clear()
+    for i in range(turns):
+        main.generate_response_w_RAG(store, f"When are you open, question {i}?")
+    blocking = list(main.response_timings)
+    main.response_timings.clear()
+    for i in range(turns):
+        for _ in main.stream_response_w_RAG(store, f"When are you open, streamed question {i}?"):
+            pass
+    streamed = list(main.response_timings)
+    llm.set_client(None)
+
+    def mean(timings, key):
+        return sum(t[key] for t in timings) / len(timings) * 1000
+    print(f"turns: {turns}, stub LLM latency: {latency * 1000:.0f} ms, {token_delay * 1000:.0f} ms/token")
+    print(f"blocking: first output after {mean(blocking, 'ttft'):.0f} ms, total {mean(blocking, 'total'):.0f} ms")
+    print(f"streamed: first token after {mean(streamed, 'ttft'):.0f} ms, total {mean(streamed, 'total'):.0f} ms")
+
+
+class HashEmbeddings:
+    '''
+    Deterministic local embeddings, the normalized sum of one random vector per word.
+    Texts sharing words are close, which is enough to exercise retrieval without the embedding API.
+    '''
+    def __init__(self, dim: int = 256, latency: float = 0.0):
+        """
+        dim: vector size
+        latency: seconds to sleep per call, to simulate the API round trip
+        """
+        import numpy as np
+
+        self.np = np
+        self.dim = dim
+        self.latency = latency
+        self.words = {}
+        self.calls = 0
+
+    def word_vector(self, word: str):
+        vector = self.words.get(word)
+        if vector is None:
+            seed = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:4], "little")
+            vector = self.words[word] = self.np.random.default_rng(seed).standard_normal(self.dim)
+        return vector
+
+    def embed_documents(self, texts: list):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        vectors = []
+        for text in texts:
+            vector = sum((self.word_vector(word) for word in normalize_text(text).split()), self.np.zeros(self.dim))
+            vectors.append((vector / (self.np.linalg.norm(vector) or 1)).tolist())
+        return vectors
+
+    def embed_query(self, text: str):
+        return self.embed_documents([text])[0]
+
+def write_synthetic_kb(path: str, rows: int, seed: int = 0):
+    '''
+    Write a jsonl knowledge base of `rows` question/answer pairs made of random words.
+    '''
+    rng = random.Random(seed)
+    vocabulary = [f"w{i}" for i in range(5000)]
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(rows):
+            words = rng.sample(vocabulary, 6)
+            f.write(json.dumps({"input": "what about " + " ".join(words), "output": f"answer {i}"}) + "\n")
+
+def bench_retrieval(rows: int = 20_000, queries: int = 200, latency: float = 0.02):
+    '''
+    One query at a time (retrieve_scored) against retrieve_docs_batch, with local embeddings.
+    '''
+    from index import VectorStore
+
+    tmp = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(tmp, "data.jsonl")
+        write_synthetic_kb(data_path, rows)
+        embeddings = HashEmbeddings()
+        store = VectorStore(
+            data_path,
+            out_path=os.path.join(tmp, "kb"),
+            embedding_cache_path=os.path.join(tmp, "cache.db"),
+            embeddings=embeddings,
+            retrieval="dense",
+        )
+        embeddings.latency = latency
+        with open(data_path, encoding="utf-8") as f:
+            items = [json.loads(line) for line in f]
+        rng = random.Random(1)
+        sample = rng.sample(items, 2 * queries)
+
+        def query(item):
+            # drop one word, so queries are close to their row without matching it exactly
+            return " ".join(item["input"].split()[:-1])
+
+        single, batch = sample[:queries], sample[queries:]
+        start = time.perf_counter()
+        single_hits = [store.retrieve_scored(query(item), 5, 1.0) for item in single]
+        single_time = time.perf_counter() - start
+        start = time.perf_counter()
+        batch_hits = store.retrieve_docs_batch([query(item) for item in batch], 5, 1.0)
+        batch_time = time.perf_counter() - start
+
+        single_found = sum(bool(hits) and hits[0][0] == item["output"] for item, hits in zip(single, single_hits))
+        batch_found = sum(bool(hits["outputs"]) and hits["outputs"][0] == item["output"] for item, hits in zip(batch, batch_hits))
+        # both paths must agree on the same queries (cached embeddings by now)
+        agree = store.retrieve_docs_batch([query(item) for item in single], 5, 1.0)
+        same = sum([output for output, _ in hits] == result["outputs"] for hits, result in zip(single_hits, agree))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"rows: {rows}, queries: {queries}, stub embedding latency: {latency * 1000:.0f} ms")
+    print(f"one at a time: {single_time:.2f} s ({queries / single_time:.0f} queries/s), top-1 hit rate {single_found / queries:.0%}")
+    print(f"batched: {batch_time:.2f} s ({queries / batch_time:.0f} queries/s), top-1 hit rate {batch_found / queries:.0%}")
+    print(f"same results for {same}/{queries} queries")
+
+
+# scripted CLI sessions, each ends with "exit"
+E2E_SCRIPTS = {
+    "faq": [
+        "What is the name of the dental clinic?",
+        "What services does BrightSmile Dental Clinic offer today?",
+        "What are the Saturday opening hours for BrightSmile Dental Clinic?",
+        "How long does a root canal procedure usually take?",
+        "exit",
+    ],
+    "out_of_scope": [
+        "What's the weather like on Mars?",
+        "Can you recommend a good pizza place nearby?",
+        "exit",
+    ],
+    "booking": [
+        "I would like to book an appointment",
+        "I'm Tommy, next Tuesday at 3pm",
+        "none",
+        "yes",
+        "can I schedule an appointment?",
+        "I'm Anna, I want a booking for next Wednesday",
+        "2pm",
+        "first visit",
+        "yes",
+        "exit",
+    ],
+    "booking_llm": [
+        "my son needs an appointment",
+        "hello",
+        "Ben, sometime next week, Wednesday works",
+        "at 11",
+        "",
+        "no",
+        "exit",
+    ],
+}
+
+def _e2e_responder(recorded: dict):
+    '''
+    Recorded responses for each kind of LLM call made by the chat loop.
+    recorded: slot extraction responses keyed by user input
+    '''
+    def respond(messages):
+        content = messages[-1]["content"]
+        if "determine if the user wants to book" in content:
+            return json.dumps({"trigger": "appointment" in content.split("User input:")[1]})
+        if "extract the details of their appointment booking" in content:
+            text = content.split('User input: "')[1].rsplit('"', 1)[0]
+            return json.dumps(recorded.get(text, {"name": None, "date": None, "time": None}))
+        return "We are open from 9 AM to 5 PM on weekdays and from 10 AM to 2 PM on Saturdays, closed on Sundays."
+    return respond
+
+class ScriptEnded(Exception):
+    pass
+
+def percentile(values: list, p: float):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+def bench_e2e(rounds: int = 20, latency: float = 0.05, embed_latency: float = 0.02, ops: int = 2000):
+    '''
+    Replay scripted sessions through chat_loop/process_booking with a stub LLM and stub embeddings, no network.
+    Reports per-turn latency percentiles, LLM calls and tokens per turn, and Bookings throughput.
+    '''
+    import builtins
+    import contextlib
+    import io
+    import main
+    from index import VectorStore
+
+    today = datetime.date.today()
+    next_wednesday = today + datetime.timedelta(days=7 - today.weekday() + 2)
+    recorded = {"Ben, sometime next week, Wednesday works": {"name": "Ben", "date": next_wednesday.isoformat(), "time": None}}
+    client = llm.LLMClient(llm.StubBackend(_e2e_responder(recorded), latency=latency))
+    llm.set_client(client)
+    tmp = tempfile.mkdtemp()
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    real_input = builtins.input
+    turns = {name: [] for name in E2E_SCRIPTS}
+    completed = 0
+    try:
+        embeddings = HashEmbeddings()
+        store = VectorStore(
+            os.path.join(repo_root, "data.jsonl"),
+            out_path=os.path.join(tmp, "kb"),
+            embedding_cache_path=os.path.join(tmp, "cache.db"),
+            embeddings=embeddings,
+        )
+        embeddings.latency = embed_latency
+        bookings_path = os.path.join(tmp, "bookings.csv")
+
+        for _ in range(rounds):
+            for name, script in E2E_SCRIPTS.items():
+                # every round starts cold: empty caches and the sample bookings
+                main.response_cache.clear()
+                store.embed_model.memory.clear()
+                store.embed_model.db.execute("DELETE FROM embeddings")
+                shutil.copy(os.path.join(repo_root, "bookings_sample.csv"), bookings_path)
+                bookings = Bookings(bookings_path)
+                lines = iter(script)
+                last = None
+
+                def scripted_input(prompt=""):
+                    # a turn lasts from the user's message to the next prompt
+                    nonlocal last
+                    now = time.perf_counter()
+                    if last is not None:
+                        turns[name].append((
+                            now - last[0],
+                            client.calls - last[1],
+                            client.prompt_tokens + client.completion_tokens - last[2],
+                        ))
+                    try:
+                        line = next(lines)
+                    except StopIteration:
+                        raise ScriptEnded(name)
+                    last = (time.perf_counter(), client.calls, client.prompt_tokens + client.completion_tokens)
+                    return line
+
+                builtins.input = scripted_input
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    main.chat_loop(bookings, store)
+                completed += output.getvalue().count("successfully made")
+    finally:
+        builtins.input = real_input
+        llm.set_client(None)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"rounds: {rounds}, stub LLM latency: {latency * 1000:.0f} ms, stub embedding latency: {embed_latency * 1000:.0f} ms")
+    print(f"{'script':<14}{'turns':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'calls/turn':>12}{'tokens/turn':>13}")
+    turns["all"] = [turn for timings in turns.values() for turn in timings]
+    for name, timings in turns.items():
+        seconds = [t[0] * 1000 for t in timings]
+        print(
+            f"{name:<14}{len(timings):>7}{percentile(seconds, 50):>9.1f}{percentile(seconds, 95):>9.1f}"
+            f"{percentile(seconds, 99):>9.1f}{sum(t[1] for t in timings) / len(timings):>12.2f}"
+            f"{sum(t[2] for t in timings) / len(timings):>13.0f}"
+        )
+    print(f"bookings completed: {completed} (expected {2 * rounds})")
+    assert completed == 2 * rounds, "scripted bookings did not complete"
+
+    # Bookings operations on their own, against a journaled csv
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "bookings.csv")
+        shutil.copy(os.path.join(repo_root, "bookings_sample.csv"), path)
+        bookings = Bookings(path, journal=True)
+        start_date = datetime.date(2030, 1, 1)
+        rng = random.Random(0)
+        start = time.perf_counter()
+        for _ in range(ops):
+            bookings.get_available_slots((start_date + datetime.timedelta(days=rng.randrange(365))).isoformat())
+        lookup_time = time.perf_counter() - start
+        start = time.perf_counter()
+        made = 0
+        for i in range(ops):
+            date = (start_date + datetime.timedelta(days=i // 7)).isoformat()
+            made += bookings.reserve_slot(Booking(f"Patient {i}", date, WEEKDAY_SLOTS[i % 7], ""))
+            bookings.save_bookings()
+        reserve_time = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"get_available_slots: {ops / lookup_time:,.0f} ops/s")
+    print(f"reserve_slot + save_bookings: {ops / reserve_time:,.0f} ops/s ({made} reserved)")
+
+def _timed_calls(client, calls: int, threads: int = 8):
+    '''
+    Run completions from several threads, returns (sorted seconds per call, failed calls).
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    messages = [{"role": "user", "content": "When are you open?"}]
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            client.complete(messages)
+            failed = False
+        except llm.LLMUnavailable:
+            failed = True
+        return time.perf_counter() - start, failed
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(one, range(calls)))
+    return sorted(seconds for seconds, _ in results), sum(failed for _, failed in results)
+
+def bench_resilience(calls: int = 400, latency: float = 0.02, slow_latency: float = 2.0):
+    '''
+    LLM calls against a stub injecting a latency tail and failures, with and without deadlines, retries and hedging,
+    then an outage with and without the circuit breaker, and the chat answers given meanwhile.
+    '''
+    from main import generate_response_w_RAG
+    from main import response_cache
+
+    policies = {
+        "no policy": llm.CallPolicy(deadline=60, retries=0),
+        "deadline + retries": llm.CallPolicy(deadline=1.0, retries=2, backoff=0.05, attempt_timeout=0.3),
+        "+ hedging": llm.CallPolicy(deadline=1.0, retries=2, backoff=0.05, attempt_timeout=0.3, hedge=True, hedge_after=0.1),
+    }
+    print(f"calls: {calls}, stub latency: {latency * 1000:.0f} ms, 3% take {slow_latency:.0f} s, 5% fail")
+    print(f"{'policy':<20}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'failed':>8}{'requests/call':>15}")
+    for name, policy in policies.items():
+        backend = llm.StubBackend(lambda m: "We are open 9 AM to 5 PM.", latency=latency, failure_rate=0.05,
+                                  slow_rate=0.03, slow_latency=slow_latency, seed=3)
+        client = llm.LLMClient(backend, policies={"chat": policy}, breaker=llm.CircuitBreaker(failures=calls))
+        times, failed = _timed_calls(client, calls)
+        print(f"{name:<20}" + "".join(f"{percentile(times, p) * 1000:>9.0f}" for p in (50, 95, 99, 100))
+              + f"{failed:>8}{backend.requests / calls:>15.2f}")
+
+    # upstream down, every request fails after half a second
+    print(f"outage, {calls // 4} calls:")
+    for name, breaker in [("no breaker", llm.CircuitBreaker(failures=calls)), ("circuit breaker", llm.CircuitBreaker(failures=5, reset_after=30))]:
+        backend = llm.StubBackend(latency=0.5, failure_rate=1.0)
+        client = llm.LLMClient(backend, policies={"chat": policies["deadline + retries"]}, breaker=breaker)
+        start = time.perf_counter()
+        times, failed = _timed_calls(client, calls // 4)
+        print(f"  {name:<18} {(time.perf_counter() - start):.2f} s, p50 {percentile(times, 50) * 1000:.0f} ms per call, "
+              f"{backend.requests} upstream requests, circuit {breaker.state}")
+
+    # the chat keeps answering from the knowledge base while the circuit is open
+    llm.set_client(client)
+    response_cache.clear()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            answer = generate_response_w_RAG(StubStore(), "when are you open on weekdays?")
+    finally:
+        llm.set_client(None)
+    print(f"  chat answer during the outage: {answer}")
+
+def bench_tracing(spans: int = 200_000):
+    '''
+    Cost of a span with tracing off, and with tracing on writing JSON lines.
+    '''
+    from metrics import Tracer
+
+    tmp = tempfile.mkdtemp()
+    try:
+        results = {}
+        for name, tracer in [("off", Tracer(False)), ("on", Tracer(True, os.path.join(tmp, "trace.jsonl")))]:
+            start = time.perf_counter()
+            for i in range(spans):
+                with tracer.span("stage", cached=True) as s:
+                    s.set(rows=i)
+                tracer.incr("stage_calls")
+            results[name] = (time.perf_counter() - start) / spans
+            tracer.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"spans: {spans}")
+    print(f"tracing off: {results['off'] * 1e9:.0f} ns per span + counter")
+    print(f"tracing on: {results['on'] * 1e6:.1f} µs per span + counter")
+def bench_dedupe(facts: int = 2000, paraphrases: int = 3, queries: int = 200):
+    '''
+    Knowledge base with several questions per answer, as generate_in_out_pairs produces:
+    stored answer size and context tokens per query, with answers collapsed against raw top k rows.
+    '''
+    from index import VectorStore
+
+    rng = random.Random(0)
+    vocabulary = [f"w{i}" for i in range(3000)]
+    tmp = tempfile.mkdtemp()
+    try:
+        data_path = os.path.join(tmp, "data.jsonl")
+        questions = []
+        with open(data_path, "w", encoding="utf-8") as f:
+            for i in range(facts):
+                topic = rng.sample(vocabulary, 4)
+                answer = f"Fact {i}: " + " ".join(rng.choices(vocabulary, k=40))
+                for _ in range(paraphrases):
+                    question = " ".join(topic + rng.sample(vocabulary, 2))
+                    questions.append(question)
+                    f.write(json.dumps({"input": question, "output": answer}) + "\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            store = VectorStore(data_path, out_path=os.path.join(tmp, "kb"), embedding_cache_path=os.path.join(tmp, "cache.db"), embeddings=HashEmbeddings())
+        index = store.index
+        raw_bytes = sum(len(index.output(i).encode("utf-8")) for i in range(index.rows))
+        stored_bytes = os.path.getsize(os.path.join(compact_dir(store), "answers.txt"))
+
+        sample = rng.sample(questions, queries)
+        vectors = store.embed_model.embed_documents(sample)
+        # as in retrieve_docs: top 5 under the 0.8 threshold
+        scores, positions = index.search(vectors, 5)
+        raw_tokens = sum(
+            llm.count_tokens(index.output(p))
+            for row_scores, row in zip(scores.tolist(), positions.tolist())
+            for score, p in zip(row_scores, row) if p >= 0 and score < 0.8
+        )
+        hits = store.search_distinct(index, vectors, 5, 0.8)
+        distinct_tokens = sum(llm.count_tokens(index.answer(a)) for query_hits in hits for _, a, _ in query_hits)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"rows: {index.rows}, distinct answers: {index.answer_count}")
+    print(f"answers stored: {stored_bytes / 1024:.0f} KB, against {raw_bytes / 1024:.0f} KB one per row")
+    print(f"context tokens per query (top 5 under 0.8): {raw_tokens / queries:.0f} raw rows, {distinct_tokens / queries:.0f} distinct answers")
+
+# (query, a phrase of the expected answer, None when out of scope) against data.jsonl
+HYBRID_QUERIES = [
+    ("phone number", "123-4567"),
+    ("address", "Smile Street"),
+    ("Sunday", "closed on Sundays"),
+    ("email", "contact@"),
+    ("insurance", "insurance plans"),
+    ("saturday hours", "Saturday: 10"),
+    ("walk-in", "walk-ins"),
+    ("dental emergency", "call us immediately"),
+    ("What is the phone number for BrightSmile Dental Clinic?", "123-4567"),
+    ("Is BrightSmile Dental Clinic open on Sundays?", "closed on Sundays"),
+    ("how long does a root canal take", "1–2 hours"),
+    ("who does braces consultations", "orthodontist"),
+    ("how often should I get my teeth cleaned", "6 months"),
+    ("is whitening safe", "completely safe"),
+    ("fillings types", "composite"),
+    ("where are you located", "Smile Street"),
+    ("What's the weather like on Mars?", None),
+    ("Can you recommend a good pizza place nearby?", None),
+    ("who won the football game", None),
+    ("stock price of apple", None),
+]
+
+def bench_hybrid(latency: float = 0.05, data_path: str = "data.jsonl"):
+    '''
+    Hybrid (lexical + vector) against dense-only retrieval on the knowledge base: latency and embedding calls,
+    and whether the answers given from the lexical index alone, without an embedding call, are the expected ones.
+    The stub embeddings are sums of random word vectors, far weaker than a real embedding model,
+    so the hit rate of the dense side is not compared, it would say nothing about real retrieval quality.
+    '''
+    from index import VectorStore
+
+    tmp = tempfile.mkdtemp()
+    try:
+        embeddings = HashEmbeddings()
+        with contextlib.redirect_stdout(io.StringIO()):
+            VectorStore(data_path, out_path=os.path.join(tmp, "kb"), embedding_cache_path=os.path.join(tmp, "build.db"), embeddings=embeddings)
+        embeddings.latency = latency
+        print(f"queries: {len(HYBRID_QUERIES)}, stub embedding latency: {latency * 1000:.0f} ms")
+        print(f"{'mode':<8}{'p50 ms':>9}{'p95 ms':>9}{'embed calls':>13}{'no embedding':>14}{'as expected':>13}")
+        for mode in ("dense", "hybrid"):
+            # a cache per mode, every query pays for its embedding once
+            store = VectorStore(data_path, os.path.join(tmp, "kb"), embedding_cache_path=os.path.join(tmp, f"{mode}.db"), embeddings=embeddings, retrieval=mode)
+            calls = embeddings.calls
+            times, lexical, lexical_found = [], 0, 0
+            for query, expected in HYBRID_QUERIES:
+                query_calls = embeddings.calls
+                start = time.perf_counter()
+                hits = store.retrieve_scored(query)
+                times.append(time.perf_counter() - start)
+                if embeddings.calls == query_calls:
+                    # answered from the lexical index alone, its answer does not depend on the embeddings
+                    lexical += 1
+                    lexical_found += not hits if expected is None else bool(hits) and expected in hits[0][0]
+            print(f"{mode:<8}{percentile(times, 50) * 1000:>9.1f}{percentile(times, 95) * 1000:>9.1f}"
+                  f"{embeddings.calls - calls:>13}{lexical:>14}{lexical_found:>9}/{lexical}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def bench_ann(rows: int = 100_000, dim: int = 256, queries: int = 200, k: int = 10):
+    '''
+    Recall@k, query latency and memory of each ANN index type against the exact scan, on clustered
+    unit vectors like embeddings of paraphrased questions. Distances are re-scored exactly, so the hits
+    under a relevance threshold should match the exact scan's as long as recall holds.
+    '''
+    import numpy as np
+    import ann
+    from index import CompactIndex
+
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((rows // 20, dim)).astype(np.float32)
+    vectors = centers[rng.integers(len(centers), size=rows)] + 0.6 * rng.standard_normal((rows, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # a reworded known question: a row plus noise
+    picked = vectors[rng.choice(rows, queries, replace=False)]
+    query_vectors = picked + 0.4 * rng.standard_normal((queries, dim)).astype(np.float32) / np.sqrt(dim)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, "compact")
+        CompactIndex.write(path, vectors, [f"answer {i}" for i in range(rows)], [f"question {i}" for i in range(rows)])
+        exact_distances, exact_positions = CompactIndex(path).search(query_vectors, k)
+        # the median distance of the k-th hit, so about half of the top k count as relevant
+        threshold = float(np.median(exact_distances[:, -1]))
+        exact_relevant = [set(p[d < threshold]) for d, p in zip(exact_distances, exact_positions)]
+
+        print(f"rows: {rows}, dim: {dim}, queries: {queries}, k: {k}, refine: {ann.REFINE}x, nprobe: {ann.NPROBE}, efSearch: {ann.EF_SEARCH}")
+        # re-scoring reads the float32 vectors whatever the type, the ANN index comes on top
+        vectors_size = os.path.getsize(os.path.join(path, "vectors.f32"))
+        print(f"{'index':<9}{'build s':>9}{'open ms':>9}{'vectors MB':>12}{'ANN MB':>8}{'recall@k':>10}{'p50 ms':>9}{'p99 ms':>9}{'same hits':>11}{'max error':>11}")
+        for index_type in ann.INDEX_TYPES:
+            # built by the writer, as export_compact does, readers only load it
+            start = time.perf_counter()
+            if index_type != "flat":
+                ann.build(path, vectors, index_type)
+            build_time = time.perf_counter() - start
+            start = time.perf_counter()
+            index = CompactIndex(path, index_type)
+            open_time = time.perf_counter() - start
+            ann_size = os.path.getsize(ann.ann_path(path, index_type)) if index_type != "flat" else 0
+            latencies = []
+            distances, positions = [], []
+            # one query at a time, as a chat turn searches
+            for query in query_vectors:
+                start = time.perf_counter()
+                d, p = index.search(query[None, :], k)
+                latencies.append(time.perf_counter() - start)
+                distances.append(d[0])
+                positions.append(p[0])
+            recall = np.mean([len(set(p) & set(e)) / k for p, e in zip(positions, exact_positions)])
+            relevant = sum(set(p[d < threshold]) == e for d, p, e in zip(distances, positions, exact_relevant))
+            # re-scored distances of the rows both found, against the exact scan's
+            error = max(
+                (abs(float(dd) - float(ed)) for d, p, ed_row, ep in zip(distances, positions, exact_distances, exact_positions)
+                 for dd, pp in zip(d, p) for ed, epp in zip(ed_row, ep) if pp == epp),
+                default=0.0,
+            )
+            print(f"{index_type:<9}{build_time:>9.2f}{open_time * 1000:>9.1f}{vectors_size / 2 ** 20:>12.1f}{ann_size / 2 ** 20:>8.1f}{recall:>10.3f}"
+                  f"{percentile(latencies, 50) * 1000:>9.2f}{percentile(latencies, 99) * 1000:>9.2f}"
+                  f"{relevant:>7}/{queries}{error:>11.1e}")
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def compact_dir(store):
+    from index import compact_path
+
+    return compact_path(store.store_path, store.version)
+
+STARTUP_PROBE = """
+import time
+start = time.perf_counter()
+{code}
+seconds = time.perf_counter() - start
+# resident memory once loaded, ru_maxrss would include the parent's peak from before exec
+rss = [line.split()[1] for line in open("/proc/self/status") if line.startswith("VmRSS")][0]
+print(seconds, int(rss) // 1024)
+"""
+
+def _probe(code: str):
+    '''
+    Run code in a fresh interpreter, returns (seconds, resident memory in MB afterwards).
+    '''
+    import subprocess
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_PROBE.format(code=code)],
+        cwd=app_dir, capture_output=True, text=True, check=True,
+    )
+    seconds, rss = result.stdout.split()[-2:]
+    return float(seconds), int(rss)
+
+def bench_startup(sizes: tuple = (1000, 10_000, 30_000)):
+    '''
+    Cold start of the CLI module, and opening the index from the pickled FAISS files against the compact mmap format.
+    '''
+    seconds, rss = _probe("import main")
+    print(f"import main: {seconds * 1000:.0f} ms, {rss} MB resident")
+    from index import VectorStore
+
+    print(f"{'rows':>8}{'FAISS ms':>11}{'FAISS MB':>10}{'compact ms':>12}{'compact MB':>12}")
+    for rows in sizes:
+        tmp = tempfile.mkdtemp()
+        try:
+            data_path = os.path.join(tmp, "data.jsonl")
+            kb_path = os.path.join(tmp, "kb")
+            write_synthetic_kb(data_path, rows)
+            with contextlib.redirect_stdout(io.StringIO()):
+                VectorStore(data_path, out_path=kb_path, embedding_cache_path=os.path.join(tmp, "cache.db"), embeddings=HashEmbeddings(1536))
+            faiss_seconds, faiss_rss = _probe(
+                "from langchain_community.vectorstores import FAISS\n"
+                "from benchmarks import HashEmbeddings\n"
+                f"store = FAISS.load_local({kb_path!r}, HashEmbeddings(1536), allow_dangerous_deserialization=True)"
+            )
+            compact_seconds, compact_rss = _probe(
+                "from index import VectorStore\n"
+                "from benchmarks import HashEmbeddings\n"
+                f"store = VectorStore({data_path!r}, {kb_path!r}, embedding_cache_path={os.path.join(tmp, 'cache.db')!r}, embeddings=HashEmbeddings(1536))"
+            )
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        print(f"{rows:>8}{faiss_seconds * 1000:>11.0f}{faiss_rss:>10}{compact_seconds * 1000:>12.0f}{compact_rss:>12}")
+
+
+BENCHMARKS = {
+    "bookings": bench_bookings,
+    "next_slots": bench_next_slots,
+    "sqlite": bench_sqlite,
+    "intent": bench_intent,
+    "parsing": bench_parsing,
+    "slots": bench_slots,
+    "server": bench_server,
+    "streaming": bench_streaming,
+    "retrieval": bench_retrieval,
+    "e2e": bench_e2e,
+    "tracing": bench_tracing,
+    "resilience": bench_resilience,
+    "startup": bench_startup,
+    "dedupe": bench_dedupe,
+    "hybrid": bench_hybrid,
+    "ann": bench_ann,
+}
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print("--" * 40)
+        print(f"Benchmark: {name}")
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,28 @@
-import pandas as pd
 import datetime
+import json
+import os
+import sqlite3
+import threading
+
+from metrics import span
+
+# opening hours template, 1 hour slots keyed by starting hour (12 is lunch break)
+WEEKDAY_SLOTS = [9, 10, 11, 13, 14, 15, 16]
+SATURDAY_SLOTS = [10, 11, 13]
+# weekday (0 is Monday) -> opening hours template, closed on Sunday
+OPENING_HOURS = {0: WEEKDAY_SLOTS, 1: WEEKDAY_SLOTS, 2: WEEKDAY_SLOTS, 3: WEEKDAY_SLOTS, 4: WEEKDAY_SLOTS, 5: SATURDAY_SLOTS, 6: []}
+
+def calendar_from_env():
+    '''
+    Bookings options from .env: CLINIC_HOLIDAYS, comma separated dates the clinic is closed on,
+    and CLINIC_OPENING_HOURS, JSON of weekday (0 is Monday) -> starting hours, e.g. {"5": [10, 11]}
+    for weekdays that differ from OPENING_HOURS.
+    '''
+    holidays = [date.strip() for date in os.getenv("CLINIC_HOLIDAYS", "").split(",") if date.strip()]
+    opening_hours = dict(OPENING_HOURS)
+    for day, hours in json.loads(os.getenv("CLINIC_OPENING_HOURS", "{}")).items():
+        opening_hours[int(day)] = [int(hour) for hour in hours]
+    return {"holidays": holidays, "opening_hours": opening_hours}
 
 class Booking:
     def __init__(self, name, date, time, remarks = ""):
@@ -8,25 +31,280 @@ class Booking:
         self.time = time
         self.remarks = remarks
 
+class CsvStore:
+    def __init__(self, file_path: str="bookings_sample.csv", journal: bool=False, compact_every: int=None):
+        """
+        Booking storage backed by a csv snapshot, optionally with an append-only journal.
+        file_path: path to the csv snapshot of all bookings
+        journal: if True, saved bookings are appended to "<file_path>.journal" instead of rewriting the csv
+            the journal is replayed on load and folded back into the csv by compact()
+        compact_every: in journal mode, compact automatically once the journal holds this many records
+            optional, if not provided, compaction only happens when compact() is called
+        """
+        self.file_path = file_path
+        self.journal = journal
+        self.journal_path = file_path + ".journal"
+        self.compact_every = compact_every
+        # number of rows in the snapshot, journal records before this position are already in it
+        self.snapshot_count = 0
+        self.journal_count = 0
+
+    def load(self):
+        # pandas is only imported once bookings are loaded, keeps the chat startup fast
+        import pandas as pd
+
+        df = pd.read_csv(self.file_path)
+        records = df.to_dict(orient='records')
+        self.snapshot_count = len(records)
+        self.journal_count = 0
+        if self.journal:
+            self.replay_journal(records)
+        return records
+
+    def replay_journal(self, records: list):
+        '''
+        Apply the bookings recorded in the journal on top of the loaded snapshot.
+        '''
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb+") as f:
+            end = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # a crash mid-append left a partial last line, cut it off so the next append starts on a line of its own
+                    print(f"Dropping partial journal line: {line.decode('utf-8', 'replace')}")
+                    f.truncate(end)
+                    os.fsync(f.fileno())
+                    break
+                end += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"Skipping invalid journal line: {line.decode('utf-8', 'replace').strip()} - Error: {e}")
+                    continue
+                self.journal_count += 1
+                # already folded into the snapshot by a compaction that was interrupted before truncating
+                if record.pop("seq") < self.snapshot_count:
+                    continue
+                records.append(record)
+
+    def reserve(self, booking: dict):
+        # a csv is only shared within this process, slot checks are done against the in-memory index
+        return True
+
+    def occupied(self, date: str):
+        # no external writers, the in-memory index is authoritative
+        return None
+
+    def occupied_range(self, start: str, end: str):
+        return None
+
+    def save(self, bookings: list, start: int):
+        '''
+        Persist bookings[start:], the bookings added since the last save.
+        '''
+        if self.journal:
+            return self.append_journal(bookings, start)
+        self._write_snapshot(bookings)
+        return True
+
+    def _write_snapshot(self, bookings: list):
+        '''
+        Rewrite the csv with all bookings, via a temporary file so a crash never leaves a truncated csv.
+        '''
+        import pandas as pd
+
+        tmp_path = self.file_path + ".tmp"
+        df = pd.DataFrame(bookings)
+        df.to_csv(tmp_path, index=False)
+        with open(tmp_path, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        self.snapshot_count = len(bookings)
+
+    def append_journal(self, bookings: list, start: int):
+        '''
+        Append the unsaved bookings to the journal and fsync, cost does not depend on the number of bookings.
+        '''
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            for seq in range(start, len(bookings)):
+                record = dict(bookings[seq], seq=seq)
+                f.write(json.dumps(record) + "\n")
+                self.journal_count += 1
+            f.flush()
+            os.fsync(f.fileno())
+        if self.compact_every is not None and self.journal_count >= self.compact_every:
+            self.compact(bookings)
+        return True
+
+    def compact(self, bookings: list):
+        '''
+        Fold the journal back into the csv snapshot and truncate the journal.
+        '''
+        # nothing was appended since the last snapshot, it is up to date
+        if self.journal_count == 0:
+            return True
+        self._write_snapshot(bookings)
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "w", encoding="utf-8") as f:
+                os.fsync(f.fileno())
+        self.journal_count = 0
+        return True
+
+class SqliteStore:
+    def __init__(self, db_path: str="bookings.db", seed_path: str=None):
+        """
+        Booking storage backed by SQLite in WAL mode, safe to share between processes.
+        db_path: path to the SQLite database file
+        seed_path: csv to import bookings from when the database is empty
+            optional, if not provided, the database starts empty
+        """
+        self.db_path = db_path
+        # sqlite connections cannot be shared across threads, keep one per thread
+        self._local = threading.local()
+        with self.connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS bookings (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT,
+                    date TEXT NOT NULL,
+                    time INTEGER NOT NULL,
+                    remarks TEXT,
+                    UNIQUE (date, time)
+                )
+                """)
+        if seed_path is not None and self.count() == 0:
+            import pandas as pd
+
+            df = pd.read_csv(seed_path)
+            with self.connection() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO bookings (name, date, time, remarks) VALUES (?, ?, ?, ?)",
+                    [(b['name'], b['date'], int(b['time']), b['remarks']) for b in df.to_dict(orient='records')]
+                )
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL with synchronous=NORMAL is durable against application crashes and avoids an fsync per commit
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def count(self):
+        return self.connection().execute("SELECT COUNT(*) FROM bookings").fetchone()[0]
+
+    def load(self):
+        rows = self.connection().execute("SELECT name, date, time, remarks FROM bookings ORDER BY id").fetchall()
+        return [{"name": name, "date": date, "time": time, "remarks": remarks} for name, date, time, remarks in rows]
+
+    def reserve(self, booking: dict):
+        '''
+        Atomically insert the booking, returns False if the slot is already taken by any worker.
+        '''
+        try:
+            with self.connection() as conn:
+                conn.execute(
+                    "INSERT INTO bookings (name, date, time, remarks) VALUES (?, ?, ?, ?)",
+                    (booking['name'], booking['date'], int(booking['time']), booking['remarks'])
+                )
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def occupied(self, date: str):
+        '''
+        Bitmask of the hours taken on the date, read from the database so other workers' bookings are seen.
+        '''
+        mask = 0
+        for (time,) in self.connection().execute("SELECT time FROM bookings WHERE date = ?", (date,)):
+            mask |= 1 << time
+        return mask
+
+    def occupied_range(self, start: str, end: str):
+        '''
+        Occupancy masks of the dates from start to end (inclusive) that have bookings, in one query.
+        '''
+        masks = {}
+        for date, time in self.connection().execute("SELECT date, time FROM bookings WHERE date BETWEEN ? AND ?", (start, end)):
+            masks[date] = masks.get(date, 0) | (1 << time)
+        return masks
+
+    def save(self, bookings: list, start: int):
+        # every booking is committed when it is reserved
+        return True
+
+    def compact(self, bookings: list):
+        with self.connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+
 class Bookings:
-    def __init__(self, file_path: str="bookings_sample.csv"):
-        ##parse csv file
-        self.bookings = self.load_bookings(file_path)
+    def __init__(self, file_path: str="bookings_sample.csv", journal: bool=False, compact_every: int=None, store=None, opening_hours: dict=None, holidays: list=None):
+        """
+        Initialize the bookings.
+        file_path, journal, compact_every: options for the default CsvStore, see CsvStore
+        store: storage backend, e.g. SqliteStore for bookings shared between chat workers
+            optional, if not provided, a CsvStore on file_path is used
+        opening_hours: weekday (0 is Monday) -> starting hours of the 1 hour slots, weekdays left out are closed
+            optional, if not provided, OPENING_HOURS
+        holidays: dates ("YYYY-MM-DD" or datetime.date) the clinic is closed on
+            optional, if not provided, none
+        """
         self.file_path = file_path
+        self.store = store if store is not None else CsvStore(file_path, journal, compact_every)
+        self.lock = threading.Lock()
+        opening_hours = OPENING_HOURS if opening_hours is None else opening_hours
+        # weekday -> bitmask of the opening hours, same layout as the occupancy masks
+        self.opening_masks = [sum(1 << hour for hour in set(opening_hours.get(day, []))) for day in range(7)]
+        self.holidays = {str(date) for date in holidays or []}
+        # date -> bitmask of occupied hours, bit n set means the slot starting at n is taken
+        self.occupancy = {}
+        ##parse csv file
+        self.bookings = self.load_bookings()
+        # bookings[saved_count:] have been added but not saved yet
+        self.saved_count = len(self.bookings)
     
-    def load_bookings(self, file_path: str):
-        df = pd.read_csv(file_path)
-        return df.to_dict(orient='records')
+    def load_bookings(self):
+        records = self.store.load()
+        self.occupancy = {}
+        for booking in records:
+            self._mark_occupied(booking['date'], booking['time'])
+        return records
+
+    def _mark_occupied(self, date, time):
+        '''
+        Set the bit for the given time in the date's occupancy mask.
+        '''
+        try:
+            hour = int(time)
+        except (TypeError, ValueError):
+            print(f"Error indexing booking time: {time} for date: {date}")
+            return False
+        self.occupancy[str(date)] = self.occupancy.get(str(date), 0) | (1 << hour)
+        return True
 
     def save_bookings(self):
         try:
-            df = pd.DataFrame(self.bookings)
-            df.to_csv(self.file_path, index=False)
+            with self.lock, span("save_bookings", store=type(self.store).__name__) as s:
+                s.set(rows=len(self.bookings) - self.saved_count)
+                self.store.save(self.bookings, self.saved_count)
+                self.saved_count = len(self.bookings)
             return True
         except Exception as e:
             print(f"Error saving bookings: {e}")
             return False
 
+    def compact(self):
+        try:
+            with self.lock:
+                return self.store.compact(self.bookings)
+        except Exception as e:
+            print(f"Error compacting bookings: {e}")
+            return False
+
     def add_booking(self, Booking :Booking):
         booking = {
             "name": Booking.name,
@@ -35,34 +313,92 @@ class Bookings:
             "remarks": Booking.remarks
         }
         try:
+            if not self.store.reserve(booking):
+                print(f"Slot {booking['time']} on {booking['date']} is already booked")
+                return False
             self.bookings.append(booking)
+            self._mark_occupied(booking['date'], booking['time'])
             return True
         except Exception as e:
             print(f"Error adding booking: {e}")
             return False
 
+    def reserve_slot(self, Booking :Booking):
+        '''
+        Add the booking only if its slot is still free, returns False if it has been taken.
+        '''
+        with self.lock, span("reserve_slot") as s:
+            if int(Booking.time) not in self.get_available_slots(Booking.date):
+                s.set(reserved=False)
+                return False
+            reserved = self.add_booking(Booking)
+            s.set(reserved=reserved)
+            return reserved
+
+    def opening_mask(self, date: datetime.date):
+        '''
+        Bitmask of the opening hours on the date, 0 on holidays.
+        '''
+        if date.isoformat() in self.holidays:
+            return 0
+        return self.opening_masks[date.weekday()]
+
     def get_available_slots(self, date):
         # Weekday available slots are from 9 to 16 (9 AM to 4 PM)( 1 hours slots)(12 lunch break)
         # Saturday available slots are from 10 to 13 (9 AM to 1 PM)( 1 hours slots)(lunch break at 12)
-        # no slots on Sunday
-
-        # get the day of the week
-        day = datetime.datetime.strptime(date, "%Y-%m-%d").weekday()
-        if day == 6:  # Sunday
+        # no slots on Sunday and holidays, see OPENING_HOURS
+        opening = self.opening_mask(datetime.datetime.strptime(date, "%Y-%m-%d").date())
+        if not opening:
             return []
-        if day == 5:  # Saturday
-            available_slots = [10, 11, 13]
-        else:  
-            available_slots = [9, 10, 11, 13, 14, 15, 16]
-        for booking in self.bookings:
-            try:
-                if booking['date'] == date:
-                    available_slots.remove(int(booking['time']))
-            except ValueError:
-                print(f"Error removing booking time: {booking['time']} for date: {date}")
-                continue
+        # occupancy is indexed per date, so the lookup does not depend on the size of the history
+        occupied = self.store.occupied(date)
+        if occupied is None:
+            occupied = self.occupancy.get(date, 0)
+        return hours_of(opening & ~occupied)
+
+    def next_available_slots(self, start, count: int=3, end=None, per_day: int=None, max_days: int=180):
+        '''
+        The first free slots from start onwards, as (date "YYYY-MM-DD", hour) in time order.
+        start, end: first and last date to search, "YYYY-MM-DD" or datetime.date
+            end is optional, if not provided, max_days after start
+        count: number of slots to return, fewer if the range runs out
+        per_day: at most this many slots per date, e.g. 1 to offer several dates
+            optional, if not provided, no limit
+        Each date costs a bitmask lookup, a range over months takes microseconds whatever the history size.
+        '''
+        if isinstance(start, str):
+            start = datetime.datetime.strptime(start, "%Y-%m-%d").date()
+        if end is None:
+            end = start + datetime.timedelta(days=max_days)
+        elif isinstance(end, str):
+            end = datetime.datetime.strptime(end, "%Y-%m-%d").date()
+        with span("next_available_slots") as s:
+            # shared stores are read once for the whole range
+            occupancy = self.store.occupied_range(start.isoformat(), end.isoformat())
+            if occupancy is None:
+                occupancy = self.occupancy
+            slots = []
+            date = start
+            while date <= end and len(slots) < count:
+                opening = self.opening_mask(date)
+                if opening:
+                    date_str = date.isoformat()
+                    hours = hours_of(opening & ~occupancy.get(date_str, 0))
+                    slots.extend((date_str, hour) for hour in hours[:per_day][:count - len(slots)])
+                date += datetime.timedelta(days=1)
+            s.set(slots=len(slots), days=(date - start).days)
+        return slots
 
-        return available_slots
+def hours_of(mask: int):
+    '''
+    Hours whose bits are set in the mask, in ascending order.
+    '''
+    hours = []
+    while mask:
+        low = mask & -mask
+        hours.append(low.bit_length() - 1)
+        mask ^= low
+    return hours
 
 
 def test():
@@ -73,4 +409,4 @@ def test():
     print(f"Available slots for {date}: {avail}")
 
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    test()
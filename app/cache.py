@@ -0,0 +1,54 @@
+'''
+Small in-process caches shared by the chat and retrieval code.
+'''
+import re
+import threading
+import time
+from collections import OrderedDict
+
+def normalize_text(text: str):
+    '''
+    Lowercase, drop punctuation and collapse whitespace, so trivially different queries share a cache key.
+    '''
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = None):
+        """
+        Thread-safe least-recently-used cache.
+        maxsize: maximum number of entries, the least recently used entry is evicted beyond this
+        ttl: seconds an entry stays valid
+            optional, if not provided, entries only leave the cache by eviction
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[1] > self.ttl):
+                if entry is not None:
+                    del self.data[key]
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic())
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
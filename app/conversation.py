@@ -0,0 +1,216 @@
+'''
+The chat conversation as an explicit state machine, one handle() call per user message.
+Follows the same steps and messages as chat_loop/process_booking in main.py, but keeps the
+conversation state in the object instead of a blocking input() loop, so a server can hold many.
+'''
+import datetime
+
+from booking import Booking
+from booking import Bookings
+from index import VectorStore
+from main import format_hour
+from main import generate_response_w_RAG
+from main import is_booking_request
+from main import slot_filler
+from main import stream_response_w_RAG
+from main import suggest_slots
+from main import verify_date
+from metrics import span
+
+# states
+QA = "qa"
+COLLECTING = "collecting"      # name and date
+PICKING_TIME = "picking_time"
+REMARKS = "remarks"
+CONFIRMING = "confirming"
+
+class Conversation:
+    def __init__(self, bookings: Bookings, store: VectorStore, today: datetime.date = None):
+        """
+        bookings, store: shared by all conversations
+        today: date bookings are made relative to
+            optional, if not provided, the current date when the booking starts
+        """
+        self.bookings = bookings
+        self.store = store
+        self.today = today
+        self.state = QA
+        self.slots = None
+        self.avail = []
+        self.remarks = ""
+        # RAG token usage of this conversation
+        self.usage = {"prompt_tokens": 0, "completion_tokens": 0, "answers": 0}
+
+    def greeting(self):
+        return [
+            "Welcome to BrightSmile Dental Clinic!",
+            "I am your virtual assistant. I can help you with your queries and set up appointments.",
+        ]
+
+    def handle(self, message: str):
+        '''
+        Process one user message, returns the assistant's replies.
+        '''
+        handlers = {
+            QA: self.handle_qa,
+            COLLECTING: self.handle_collecting,
+            PICKING_TIME: self.handle_picking_time,
+            REMARKS: self.handle_remarks,
+            CONFIRMING: self.handle_confirming,
+        }
+        with span("turn", state=self.state):
+            return handlers[self.state](message.strip())
+
+    def handle_stream(self, message: str):
+        '''
+        Like handle(), but yields events as they are ready: {"delta": text} for the chunks of a
+        streamed answer, {"reply": text} for whole replies.
+        '''
+        message = message.strip()
+        if self.state == QA and message:
+            with span("turn", state=QA, streamed=True):
+                if is_booking_request(message):
+                    for reply in self.start_booking():
+                        yield {"reply": reply}
+                    return
+                self.store.refresh()
+                for chunk in stream_response_w_RAG(self.store, message, usage=self.usage):
+                    yield {"delta": chunk}
+            return
+        for reply in self.handle(message):
+            yield {"reply": reply}
+
+    def handle_qa(self, prompt: str):
+        if prompt == "":
+            return []
+        if is_booking_request(prompt):
+            return self.start_booking()
+        # pick up knowledge base updates made by add_PDF_to_KnowledgeBase in another process
+        self.store.refresh()
+        return [generate_response_w_RAG(self.store, prompt, usage=self.usage)]
+
+    def start_booking(self):
+        today = self.today or datetime.datetime.now().date()
+        self.slots = slot_filler.new_booking(today)
+        self.remarks = ""
+        self.state = COLLECTING
+        return [
+            "It seems like you want to book an appointment. Let me help you with that.",
+            "Please tell me your name and preferred date.",
+        ]
+
+    def check_date(self, replies: list):
+        # reset the date if it cannot be booked
+        if self.slots.date is False:
+            return
+        verf, message = verify_date(self.slots.date, self.slots.today, self.bookings)
+        if not verf:
+            replies.append(str(message))
+            self.slots.date = False
+
+    def handle_collecting(self, text: str):
+        replies = []
+        missing = [slot for slot in ["name", "date"] if getattr(self.slots, slot) is False]
+        if text == "":
+            replies.append("Please provide a valid " + " and ".join(missing) + ".")
+        else:
+            filled = slot_filler.fill(text, self.slots, missing)
+            if missing == ["date"] and "date" not in filled:
+                replies.append("Sorry, I didn't get the date. Please try again.")
+            self.check_date(replies)
+        return replies + self.next_step()
+
+    def handle_picking_time(self, text: str):
+        if text == "":
+            return ["Please provide a valid time."]
+        if text.lower() in ("back", "go back", "cancel"):
+            # Reset date selection to try another date
+            self.slots.date = False
+            self.slots.time = False
+            return self.next_step()
+
+        replies = []
+        date = self.slots.date
+        filled = slot_filler.fill(text, self.slots, ["time"])
+        if self.slots.date != date:
+            # the user picked another date instead, check its availability first
+            self.check_date(replies)
+        elif "time" not in filled:
+            return ["Sorry, I didn't get the time. Please try again."]
+        return replies + self.next_step()
+
+    def next_step(self):
+        '''
+        Ask for whatever the booking still needs, moving to the matching state.
+        '''
+        replies = []
+        slots = self.slots
+        while True:
+            missing = [slot for slot in ["name", "date"] if getattr(slots, slot) is False]
+            if missing:
+                self.state = COLLECTING
+                if missing == ["name"]:
+                    replies.append("Sorry, I didn't get your name. Could you repeat it?")
+                elif missing == ["date"]:
+                    replies.append("Can I have your preferred date for the appointment.")
+                else:
+                    replies.append("Can I have your name and preferred date for the appointment.")
+                return replies
+
+            self.avail = self.bookings.get_available_slots(slots.date)
+            if len(self.avail) == 0:
+                # the reply already asks for another date
+                replies.append(f"Sorry, there are no available slots for {slots.date}. {suggest_slots(self.bookings, slots.date)}")
+                slots.date = False
+                self.state = COLLECTING
+                return replies
+
+            if slots.time is not False:
+                if int(slots.time) in self.avail:
+                    slots.time = int(slots.time)
+                    self.state = REMARKS
+                    replies.append(f"Got it! {slots.name}, Your appointment will be on {slots.date} at {format_hour(slots.time)}.")
+                    replies.append("Do you have any remarks or special requests that you would like us to know?")
+                    return replies
+                replies.append("Sorry, the time you selected is not available. Please choose another time slot.")
+                slots.time = False
+
+            self.state = PICKING_TIME
+            avail_str = ", ".join(format_hour(i) for i in self.avail)
+            replies.append(f"Here are the available time slots for {slots.date}: {avail_str}")
+            replies.append("Please choose a time from the available slots or type \"back\" to choose another date.")
+            return replies
+
+    def handle_remarks(self, text: str):
+        self.remarks = text
+        self.state = CONFIRMING
+        slots = self.slots
+        return [
+            "Booking Summary:\n"
+            f"Name: {slots.name}\n"
+            f"Date: {slots.date}\n"
+            f"Time: {format_hour(slots.time)}\n"
+            f"Remarks: {self.remarks}",
+            "Please confirm your booking (yes/no).",
+        ]
+
+    def handle_confirming(self, text: str):
+        slots = self.slots
+        replies = []
+        if text.lower() in ("yes", "y", "confirm"):
+            # save the booking
+            booking = Booking(slots.name, slots.date, slots.time, self.remarks)
+            if self.bookings.reserve_slot(booking):
+                if self.bookings.save_bookings():
+                    slot_filler.complete(slots)
+                    replies.append("Your booking has been successfully made.")
+                else:
+                    replies.append("Error making booking.")
+            else:
+                replies.append(f"Sorry, the {format_hour(slots.time)} slot on {slots.date} has just been taken. Please try booking again.")
+        else:
+            replies.append("Booking cancelled.")
+        self.state = QA
+        self.slots = None
+        replies.append("Do you have any additional queries or wish to set up an appointment?")
+        return replies
@@ -1,17 +1,285 @@
 
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain.schema import Document
-import fitz
+from langchain_core.embeddings import Embeddings
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
+from llm import count_tokens
+from llm import get_client
+from cache import LRUCache
+from cache import normalize_text
+from lexical import LexicalIndex
+import ann
+from metrics import incr
+from metrics import span
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+import hashlib
 import json
+import numpy as np
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
 
 load_dotenv()
 
+# hybrid retrieval: lexical coverage shrinks a row's distance by up to this share
+LEXICAL_WEIGHT = float(os.getenv("LEXICAL_WEIGHT", "0.3"))
+# the lexical index answers alone when its top answer matches this share of the query terms' idf...
+LEXICAL_MIN_COVERAGE = float(os.getenv("LEXICAL_MIN_COVERAGE", "1.0"))
+# ...and scores at least this many times the next distinct answer
+LEXICAL_MARGIN = float(os.getenv("LEXICAL_MARGIN", "1.5"))
+# weight of the answers' text next to the questions' in lexical scores, 0 to search questions only
+LEXICAL_OUTPUT_WEIGHT = float(os.getenv("LEXICAL_OUTPUT_WEIGHT", "0.0"))
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embed_model: Embeddings, model_name: str, cache_path: str="embedding_cache.db", maxsize: int=4096):
+        """
+        Embeddings with an in-process LRU in front of an on-disk cache, misses go to embed_model.
+        embed_model: the embeddings to cache, e.g. OpenAIEmbeddings
+        model_name: name of the embedding model, part of the cache key
+        cache_path: path to the SQLite file holding the on-disk cache
+        maxsize: number of vectors kept in memory
+        Vectors are returned as float32 numpy arrays, 6 KB for 1536 dimensions where a list of floats takes about 49 KB.
+        """
+        self.embed_model = embed_model
+        self.model_name = model_name
+        self.memory = LRUCache(maxsize)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(cache_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self.db.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, text: str):
+        return hashlib.sha256(f"{self.model_name}\n{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def lookup(self, keys: list):
+        '''
+        Return the cached vectors for the keys, None where not cached.
+        '''
+        vectors = [self.memory.get(key) for key in keys]
+        missing = [key for key, vector in zip(keys, vectors) if vector is None]
+        found = {}
+        with self.lock:
+            self.memory_hits += len(keys) - len(missing)
+            # stay below SQLite's bound parameter limit
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in rows)
+            self.disk_hits += len(found)
+        for key, vector in found.items():
+            self.memory.put(key, vector)
+        return [vector if vector is not None else found.get(key) for key, vector in zip(keys, vectors)]
+
+    def store(self, keys: list, vectors: list):
+        '''
+        Cache the vectors, returns them as float32 arrays.
+        '''
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        for key, vector in zip(keys, vectors):
+            self.memory.put(key, vector)
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in zip(keys, vectors)]
+            )
+            self.db.commit()
+        return vectors
+
+    def embed_documents(self, texts: list):
+        with span("embed", rows=len(texts)) as s:
+            keys = [self.key(text) for text in texts]
+            vectors = self.lookup(keys)
+            # texts sharing a key are embedded once
+            missing = {}
+            for i, vector in enumerate(vectors):
+                if vector is None:
+                    missing.setdefault(keys[i], i)
+            s.set(cached=len(texts) - len(missing))
+            if missing:
+                with self.lock:
+                    self.misses += len(missing)
+                new_vectors = self.store(list(missing), self.embed_model.embed_documents([texts[i] for i in missing.values()]))
+                embedded = dict(zip(missing, new_vectors))
+                vectors = [vector if vector is not None else embedded[key] for key, vector in zip(keys, vectors)]
+            return vectors
+
+    def embed_query(self, text: str):
+        with span("embed", rows=1) as s:
+            key = self.key(text)
+            vector = self.lookup([key])[0]
+            s.set(cached=vector is not None)
+            if vector is None:
+                with self.lock:
+                    self.misses += 1
+                vector = self.store([key], [self.embed_model.embed_query(text)])[0]
+            return vector
+
+    def stats(self):
+        return {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses}
+
+class CompactIndex:
+    '''
+    Pickle-free on-disk index, read through mmap: raw float32 vectors with their squared norms,
+    and the answers in one file indexed by an offsets array. Opening it reads no vectors,
+    so startup time and memory stay flat as the knowledge base grows.
+    Searches return the same squared L2 distances as the FAISS flat index, also when an ANN index
+    (ann.py) picks the candidates, they are re-scored from the float32 vectors.
+    Rows whose answers are the same after normalize_text share one stored answer, every row keeps its vector.
+    The BM25 index of the questions and answers (lexical.py) is kept in the same directory.
+    '''
+    # bumped when the files change, part of the directory name
+    FORMAT = 3
+    # rows compared per step, bounds the distance matrix of large batch searches
+    BLOCK_ROWS = 65536
+
+    def __init__(self, path: str, index_type: str="flat"):
+        """
+        path: directory written by CompactIndex.write
+        index_type: one of ann.INDEX_TYPES, the ANN index written with the index is loaded, it is never built here
+            indexes under ann.MIN_ROWS rows, or without an ANN index of this type, are searched exactly
+        """
+        if index_type not in ann.INDEX_TYPES:
+            raise ValueError(f"unknown index type: {index_type}")
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.rows = meta["rows"]
+        self.dim = meta["dim"]
+        self.answer_count = meta["answers"]
+        self.vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r", shape=(self.rows, self.dim))
+        self.norms = np.memmap(os.path.join(path, "norms.f32"), dtype=np.float32, mode="r", shape=(self.rows,))
+        self.answer_ids = np.memmap(os.path.join(path, "answer_ids.u32"), dtype=np.uint32, mode="r", shape=(self.rows,))
+        self.offsets = np.memmap(os.path.join(path, "answers.idx"), dtype=np.uint64, mode="r", shape=(self.answer_count + 1,))
+        answers_path = os.path.join(path, "answers.txt")
+        # np.memmap cannot map an empty file
+        self.answers = np.memmap(answers_path, dtype=np.uint8, mode="r") if os.path.getsize(answers_path) else b""
+        self.path = path
+        self._lexical = None
+        if index_type != "flat" and self.rows >= ann.MIN_ROWS and not os.path.exists(ann.ann_path(path, index_type)):
+            print(f"No {index_type} index in {path}, searching exactly until the index is updated")
+        self.index_type = index_type if self.rows >= ann.MIN_ROWS and os.path.exists(ann.ann_path(path, index_type)) else "flat"
+        self.ann = None if self.index_type == "flat" else ann.load(path, self.index_type)
+
+    @property
+    def lexical(self):
+        # only opened by hybrid retrieval
+        if self._lexical is None:
+            self._lexical = LexicalIndex(self.path)
+        return self._lexical
+
+    @staticmethod
+    def write(path: str, vectors, outputs: list, inputs: list, index_type: str="flat"):
+        '''
+        Write vectors (rows x dim), their answers and the lexical index of their questions
+        to a new directory at path, each distinct answer is stored once.
+        index_type: also build the ANN index of this type, see ann.py, training it can take minutes
+        '''
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        os.makedirs(path)
+        vectors.tofile(os.path.join(path, "vectors.f32"))
+        np.einsum("ij,ij->i", vectors, vectors).astype(np.float32).tofile(os.path.join(path, "norms.f32"))
+        # answer id of each row, answers are grouped by their normalized text and the first wording is kept
+        groups = {}
+        answer_ids = []
+        answers = []
+        offsets = [0]
+        with open(os.path.join(path, "answers.txt"), "wb") as f:
+            for output in outputs:
+                key = normalize_text(output)
+                if key not in groups:
+                    groups[key] = len(groups)
+                    answers.append(output)
+                    data = output.encode("utf-8")
+                    f.write(data)
+                    offsets.append(offsets[-1] + len(data))
+                answer_ids.append(groups[key])
+        np.asarray(answer_ids, dtype=np.uint32).tofile(os.path.join(path, "answer_ids.u32"))
+        np.asarray(offsets, dtype=np.uint64).tofile(os.path.join(path, "answers.idx"))
+        LexicalIndex.write(path, inputs, answers)
+        if index_type != "flat" and len(vectors) >= ann.MIN_ROWS:
+            ann.build(path, vectors, index_type)
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"rows": len(vectors), "dim": vectors.shape[1] if vectors.ndim == 2 else 0, "answers": len(groups)}, f)
+
+    def search(self, queries, k: int):
+        '''
+        Returns (distances, positions), both queries x k, closest first, position -1 where there are fewer than k rows.
+        '''
+        if self.ann is not None:
+            return self.search_ann(queries, k)
+        return self.search_exact(queries, k)
+
+    def search_ann(self, queries, k: int):
+        '''
+        The ANN index picks ann.REFINE candidates per result, they are ranked by their exact distance,
+        so the distances are on the same scale as search_exact's, whatever the index type.
+        '''
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        candidates = min(k * ann.REFINE, self.rows)
+        _, positions = self.ann.search(queries, candidates, params=ann.search_params(self.index_type, candidates))
+        found = positions >= 0
+        rows = np.where(found, positions, 0)
+        # only the candidates' vectors are read from the mmap
+        vectors = self.vectors[rows.ravel()].reshape(len(queries), candidates, self.dim)
+        distances = self.norms[rows] - 2 * np.einsum("qcd,qd->qc", vectors, queries) + np.einsum("qd,qd->q", queries, queries)[:, None]
+        distances = np.where(found, np.maximum(distances, 0), np.inf).astype(np.float32)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        distances = np.take_along_axis(distances, order, axis=1)
+        positions = np.where(np.isinf(distances), -1, np.take_along_axis(positions, order, axis=1))
+        if k > candidates:
+            # as search_exact, a row per result, -1 where there are fewer rows
+            distances = np.pad(distances, ((0, 0), (0, k - candidates)), constant_values=np.inf)
+            positions = np.pad(positions, ((0, 0), (0, k - candidates)), constant_values=-1)
+        return distances, positions
+
+    def search_exact(self, queries, k: int):
+        '''
+        Scan every vector, blockwise.
+        '''
+        queries = np.asarray(queries, dtype=np.float32)
+        query_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_positions = np.full((len(queries), k), -1, dtype=np.int64)
+        for start in range(0, self.rows, self.BLOCK_ROWS):
+            block = self.vectors[start:start + self.BLOCK_ROWS]
+            distances = self.norms[start:start + len(block)][None, :] - 2 * (queries @ block.T) + query_norms
+            positions = np.broadcast_to(np.arange(start, start + len(block)), distances.shape)
+            distances = np.concatenate([best_distances, np.maximum(distances, 0)], axis=1)
+            positions = np.concatenate([best_positions, positions], axis=1)
+            keep = np.argpartition(distances, k - 1, axis=1)[:, :k] if distances.shape[1] > k else np.argsort(distances, axis=1)
+            best_distances = np.take_along_axis(distances, keep, axis=1)
+            best_positions = np.take_along_axis(positions, keep, axis=1)
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        return np.take_along_axis(best_distances, order, axis=1), np.take_along_axis(best_positions, order, axis=1)
+
+    def distances(self, query, positions: list):
+        '''
+        Squared L2 distances of one query vector to the rows at positions.
+        '''
+        query = np.asarray(query, dtype=np.float32)
+        positions = np.asarray(positions, dtype=np.int64)
+        distances = self.norms[positions] - 2 * (self.vectors[positions] @ query) + query @ query
+        return np.maximum(distances, 0)
+
+    def answer_id(self, position: int):
+        return int(self.answer_ids[position])
+
+    def answer(self, answer_id: int):
+        return bytes(self.answers[int(self.offsets[answer_id]):int(self.offsets[answer_id + 1])]).decode("utf-8")
+
+    def output(self, position: int):
+        return self.answer(self.answer_id(position))
+
 class VectorStore:
-    def __init__(self, data_path: str, store_path: str=None, out_path: str="faiss_knowledge_base"):
+    def __init__(self, data_path: str, store_path: str=None, out_path: str="faiss_knowledge_base", embedding_cache_path: str="embedding_cache.db", embeddings: Embeddings=None, retrieval: str=None, index_type: str=None):
         """
         Initialize the VectorStore.
         data_path: path to the jsonl file containing data for vector store creation
@@ -19,64 +287,523 @@ class VectorStore:
             optional, if not provided, a new index will be created from data_path
         out_path: path to save the FAISS index file
             optional, default is "faiss_knowledge_base"
+        embedding_cache_path: path to the on-disk embedding cache, shared by queries and index builds
+            optional, default is "embedding_cache.db"
+        embeddings: embedding model, e.g. a local stub in benchmarks
+            optional, if not provided, OpenAI text-embedding-ada-002
+        retrieval: "dense" searches the vectors only, "hybrid" also searches the lexical index,
+            answering keyword lookups without an embedding call
+            optional, if not provided, RETRIEVAL_MODE or "dense", hybrid hit rates are not yet measured with real embeddings
+        index_type: how the compact index is searched, one of ann.INDEX_TYPES, "flat" scans it exactly
+            optional, if not provided, ANN_INDEX or "flat"
         """
-        self.embed_model = OpenAIEmbeddings(
-            model="text-embedding-ada-002"
+        self.retrieval = retrieval or os.getenv("RETRIEVAL_MODE", "dense")
+        if self.retrieval not in ("dense", "hybrid"):
+            raise ValueError(f"unknown retrieval mode: {self.retrieval}")
+        self.index_type = index_type or os.getenv("ANN_INDEX", "flat")
+        if self.index_type not in ann.INDEX_TYPES:
+            raise ValueError(f"unknown index type: {self.index_type}")
+        if embeddings is None:
+            from langchain_openai import OpenAIEmbeddings
+
+            embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
+        self.embed_model = CachedEmbeddings(
+            embeddings,
+            getattr(embeddings, "model", type(embeddings).__name__),
+            embedding_cache_path,
         )
         self.out_path = out_path
+        self.refresh_lock = threading.Lock()
+        # the LangChain FAISS store with its delta segments, only loaded when needed for updates
+        self._vector_store = None
+        self.loaded_deltas = []
         if store_path is None:
-            self.vector_store = self.create_vector_store(data_path)
+            self._vector_store = self.create_vector_store(data_path)
+            store_path = out_path
+        self.store_path = store_path
+        self.manifest = read_manifest(store_path)
+        self.manifest_mtime = manifest_mtime(store_path)
+        # identifies the index contents, caches keyed on it are invalidated when the index is rebuilt
+        self.version = self.index_version(store_path)
+        # searched by retrieval, the compact index when one matches this version
+        self.index = self.open_index(self._vector_store)
+
+    @property
+    def vector_store(self):
+        if self._vector_store is None:
+            with self.refresh_lock:
+                if self._vector_store is None:
+                    self._vector_store = self.load_faiss(self.manifest)
+        return self._vector_store
+
+    def load_faiss(self, manifest: dict):
+        '''
+        Load the saved FAISS index and merge in its delta segments.
+        '''
+        from langchain_community.vectorstores import FAISS
+
+        vector_store = FAISS.load_local(self.store_path, self.embed_model, allow_dangerous_deserialization=True)
+        for delta in manifest["deltas"] if manifest else []:
+            vector_store.merge_from(self.load_delta(delta))
+        self.loaded_deltas = list(manifest["deltas"]) if manifest else []
+        return vector_store
+
+    def index_version(self, store_path: str):
+        '''
+        Build id and delta segments of the manifest, or size and mtime of the saved index files for stores without one.
+        Only names and a stat are hashed, so startup does not slow down as the index grows.
+        '''
+        digest = hashlib.sha1()
+        if self.manifest:
+            digest.update("\n".join([self.manifest["build"]] + self.manifest["deltas"]).encode("utf-8"))
         else:
-            self.vector_store = FAISS.load_local(store_path, self.embed_model, allow_dangerous_deserialization=True)
+            for name in ["index.faiss", "index.pkl"]:
+                stat = os.stat(os.path.join(store_path, name))
+                digest.update(f"{name} {stat.st_size} {stat.st_mtime_ns}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def open_index(self, vector_store=None):
+        '''
+        Open the compact index of the current version, exporting it from the FAISS store first if there is none.
+        '''
+        path = compact_path(self.store_path, self.version)
+        if not os.path.isdir(path):
+            # the ANN index is only trained by the process that wrote the FAISS store, a reader catching up
+            # in refresh() exports the flat index and never blocks its turn on training
+            index_type = self.index_type if vector_store is not None else "flat"
+            export_compact(vector_store or self.load_faiss(self.manifest), self.store_path, self.version, index_type)
+        return CompactIndex(path, self.index_type)
+
+    def build_ann(self):
+        '''
+        Build the ANN index of the current compact index when it has none yet, e.g. it was exported by a reader
+        or ANN_INDEX changed. Meant for the process that writes the index, see update_vector_store.
+        '''
+        index = self.index
+        if self.index_type == "flat" or index.rows < ann.MIN_ROWS or os.path.exists(ann.ann_path(index.path, self.index_type)):
+            return
+        ann.build(index.path, index.vectors, self.index_type)
+        self.index = CompactIndex(index.path, self.index_type)
+
+    def load_delta(self, delta: str):
+        from langchain_community.vectorstores import FAISS
+
+        return FAISS.load_local(os.path.join(self.store_path, delta), self.embed_model, allow_dangerous_deserialization=True)
+
+    def merge_delta(self, delta: str):
+        self.vector_store.merge_from(self.load_delta(delta))
+        self.loaded_deltas.append(delta)
+
+    def embed_rows(self, rows, batch_size: int=None, workers: int=None):
+        '''
+        Build a FAISS store from an iterable of input/output pairs, embedding them in batches in parallel.
+        Each finished batch is written to the on-disk embedding cache, so an interrupted build
+        resumes from cache hits instead of embedding those rows again.
+
+        batch_size: rows per embedding request
+            optional, if not provided, EMBED_BATCH_SIZE or 500
+        workers: embedding requests in flight at once
+            optional, if not provided, EMBED_WORKERS or 4
+        '''
+        from langchain_community.vectorstores import FAISS
+
+        batch_size = batch_size or int(os.getenv("EMBED_BATCH_SIZE", "500"))
+        workers = workers or int(os.getenv("EMBED_WORKERS", "4"))
+        start = time.perf_counter()
+        vector_store = None
+        count = 0
+
+        def add(batch: list, vectors: list):
+            nonlocal vector_store, count
+            pairs = [(item["input"], vector) for item, vector in zip(batch, vectors)]
+            metadatas = [{"output": item["output"]} for item in batch]
+            if vector_store is None:
+                vector_store = FAISS.from_embeddings(pairs, self.embed_model, metadatas=metadatas)
+            else:
+                vector_store.add_embeddings(pairs, metadatas=metadatas)
+            count += len(batch)
+            elapsed = time.perf_counter() - start
+            print(f"Embedded {count} rows, {count / elapsed:.0f} rows/s")
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # batches are added in file order, at most 2 per worker are read ahead
+            pending = deque()
+            for batch in batched(rows, batch_size):
+                pending.append((batch, pool.submit(self.embed_model.embed_documents, [item["input"] for item in batch])))
+                if len(pending) >= 2 * workers:
+                    batch, future = pending.popleft()
+                    add(batch, future.result())
+            while pending:
+                batch, future = pending.popleft()
+                add(batch, future.result())
+        if vector_store is None:
+            raise ValueError("no rows to index")
+        return vector_store
 
     def create_vector_store(self, path:str):
         '''
         Create a vector store from the data in the jsonl file.
+        The file is streamed and embedded in batches, see embed_rows.
         '''
-        data = []
-        with open(path, "r", encoding="utf-8") as f:
-            for line in f:
-                try:
-                    data.append(json.loads(line))
-                except json.JSONDecodeError as e:
-                    print(f"Skipping invalid line: {line.strip()} - Error: {e}")
-                    continue  # Skip malformed lines
-
-        # Convert data into LangChain Document format
-        documents = [Document(page_content=item["input"], metadata={"output": item["output"]}) for item in data]
-        # Create FAISS vector store
-        vector_store = FAISS.from_documents(documents, self.embed_model)
+        hashes = set()
+
+        def rows():
+            for item in iter_jsonl(path):
+                hashes.add(row_hash(item))
+                yield item
+
+        vector_store = self.embed_rows(rows())
         # Save FAISS index
         vector_store.save_local(self.out_path)
-        return FAISS.load_local(self.out_path, self.embed_model, allow_dangerous_deserialization=True)
+        # a full build replaces any delta segments from earlier incremental updates
+        old_manifest = read_manifest(self.out_path)
+        for delta in old_manifest["deltas"] if old_manifest else []:
+            shutil.rmtree(os.path.join(self.out_path, delta), ignore_errors=True)
+        write_manifest(self.out_path, {
+            "build": uuid.uuid4().hex,
+            "rows": sorted(hashes),
+            "deltas": [],
+        })
+        return vector_store
+
+    def update_vector_store(self, path:str):
+        '''
+        Index only the rows of the jsonl file that are not indexed yet.
+        The new rows are saved as a delta segment next to the index, returns the number of rows added.
+        '''
+        manifest = self.manifest
+        if manifest is None:
+            # stores built before manifests existed, the indexed rows are recovered from the docstore
+            docs = self.vector_store.docstore._dict.values()
+            manifest = {
+                "build": uuid.uuid4().hex,
+                "rows": sorted({row_hash({"input": d.page_content, "output": d.metadata["output"]}) for d in docs}),
+                "deltas": [],
+            }
+        indexed = set(manifest["rows"])
+        new_rows = {}
+        for item in iter_jsonl(path):
+            new_rows.setdefault(row_hash(item), item)
+        for key in indexed:
+            new_rows.pop(key, None)
+        if not new_rows:
+            self.build_ann()
+            return 0
+
+        delta_store = self.embed_rows(new_rows.values())
+        delta = f"delta_{len(manifest['deltas']) + 1:05d}_{uuid.uuid4().hex[:8]}"
+        delta_store.save_local(os.path.join(self.store_path, delta))
+        # the manifest is written last, readers only ever see complete segments
+        manifest = {
+            "build": manifest["build"],
+            "rows": sorted(indexed | set(new_rows)),
+            "deltas": manifest["deltas"] + [delta],
+        }
+        write_manifest(self.store_path, manifest)
+        self.vector_store.merge_from(delta_store)
+        self.loaded_deltas.append(delta)
+        self.manifest = manifest
+        self.manifest_mtime = manifest_mtime(self.store_path)
+        self.version = self.index_version(self.store_path)
+        self.index = self.open_index(self.vector_store)
+        self.build_ann()
+        return len(new_rows)
+
+    def refresh(self):
+        '''
+        Pick up index changes written by another process, returns True if the index changed.
+        Only a stat call when nothing changed, cheap enough to run on every turn.
+        '''
+        if manifest_mtime(self.store_path) == self.manifest_mtime:
+            return False
+        with self.refresh_lock:
+            mtime = manifest_mtime(self.store_path)
+            manifest = read_manifest(self.store_path)
+            if mtime == self.manifest_mtime or manifest is None:
+                return False
+            # searches may be running on other threads, open the new index aside and swap it in
+            self.manifest = manifest
+            self.version = self.index_version(self.store_path)
+            self.index = self.open_index()
+            self._vector_store = None
+            self.manifest_mtime = mtime
+            return True
+
+    def search_distinct(self, index: CompactIndex, vectors, top_k: int, threshold: float):
+        '''
+        Search the index for the top k distinct answers of each query vector.
+        Paraphrased questions share an answer, so the search is widened until each query has
+        top k distinct answers under threshold or no closer rows are left.
+        Returns one list of (row, answer id, distance) per query, closest first.
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        results = [None] * len(vectors)
+        pending = np.arange(len(vectors))
+        k = min(top_k * 3, index.rows)
+        while len(pending):
+            scores, positions = index.search(vectors[pending], k)
+            # distances are sorted, the rows under threshold are a prefix of each query's results
+            under = (positions >= 0) & (scores < threshold)
+            answer_ids = np.asarray(index.answer_ids)[np.maximum(positions, 0)].astype(np.int64)
+            # first occurrence of each answer within a query: unique over (query, answer id) keys
+            keys = np.arange(len(pending))[:, None] * (index.answer_count + 1) + answer_ids
+            first = np.zeros(keys.size, dtype=bool)
+            first[np.unique(keys.ravel(), return_index=True)[1]] = True
+            keep = under & first.reshape(keys.shape)
+            keep &= np.cumsum(keep, axis=1) <= top_k
+            for i, query in enumerate(pending.tolist()):
+                columns = np.flatnonzero(keep[i])
+                results[query] = list(zip(positions[i, columns].tolist(), answer_ids[i, columns].tolist(), scores[i, columns].tolist()))
+            # all k rows were under threshold but repeated answers, the next rows may hold new ones
+            retry = (keep.sum(axis=1) < top_k) & under[:, -1] if k < index.rows else np.zeros(len(pending), dtype=bool)
+            pending = pending[retry]
+            k = min(k * 4, index.rows)
+        return results
+
+    def search_lexical(self, index: CompactIndex, query: str, top_k: int):
+        '''
+        Search the lexical index for the top k distinct answers of the query, and one more to compare with.
+        Returns (coverage of every row, list of (row, answer id, BM25 score), best first, rows whose question is the query).
+        '''
+        lexical = index.lexical
+        scores, coverage = lexical.search(query, index.answer_ids, LEXICAL_OUTPUT_WEIGHT)
+        matched = np.flatnonzero(scores)
+        ranked, seen = [], set()
+        for position in matched[np.argsort(-scores[matched], kind="stable")].tolist():
+            answer_id = index.answer_id(position)
+            if answer_id not in seen:
+                seen.add(answer_id)
+                ranked.append((position, answer_id, float(scores[position])))
+                if len(ranked) > top_k:
+                    break
+        return coverage, ranked, lexical.exact(query).tolist()
+
+    def retrieve_hybrid(self, index: CompactIndex, query: str, top_k: int, threshold: float):
+        '''
+        Lexical search first: a known question, or a top answer covering the whole query well ahead of
+        the next one, is answered without embedding the query. Otherwise the lexical and vector hits are
+        fused: a row's distance is scaled by (1 - LEXICAL_WEIGHT * coverage), so keywords lift near misses
+        under the threshold but cannot make unrelated rows relevant.
+        Returns a list of (row, answer id, distance), closest first, each answer at most once.
+        '''
+        with span("lexical_search", top_k=top_k) as s:
+            coverage, ranked, exact = self.search_lexical(index, query, top_k)
+            confident = bool(exact) or bool(ranked) and coverage[ranked[0][0]] >= LEXICAL_MIN_COVERAGE and (
+                len(ranked) == 1 or ranked[0][2] >= LEXICAL_MARGIN * ranked[1][2])
+            s.set(hits=len(ranked), confident=confident)
+        if confident:
+            incr("retrievals", path="lexical")
+            # no vector distance without the embedding, rows are placed as if at the threshold,
+            # a known question as if identical
+            hits = [(position, index.answer_id(position), 0.0) for position in exact[:1]]
+            hits += [
+                (position, answer_id, threshold * (1 - LEXICAL_WEIGHT * float(coverage[position])))
+                for position, answer_id, _ in ranked
+                if not hits or answer_id != hits[0][1]
+            ]
+            return sorted(hits, key=lambda hit: hit[2])[:top_k]
+
+        incr("retrievals", path="hybrid")
+        vector = self.embed_model.embed_query(query)
+        with span("vector_search", top_k=top_k) as s:
+            dense = self.search_distinct(index, [vector], top_k, threshold / (1 - LEXICAL_WEIGHT))[0]
+            positions = {position: distance for position, _, distance in dense}
+            extra = [position for position, _, _ in ranked if position not in positions]
+            if extra:
+                positions.update(zip(extra, index.distances(vector, extra).tolist()))
+            fused = sorted(
+                (distance * (1 - LEXICAL_WEIGHT * float(coverage[position])), position)
+                for position, distance in positions.items()
+            )
+            hits, seen = [], set()
+            for distance, position in fused:
+                answer_id = index.answer_id(position)
+                if distance < threshold and answer_id not in seen:
+                    seen.add(answer_id)
+                    hits.append((position, answer_id, distance))
+            s.set(hits=len(hits[:top_k]))
+        return hits[:top_k]
+
+    def retrieve_scored(self, query:str, top_k:int =5, threshold:float= 0.8):
+        '''
+        Retrieve top k documents from the vector store based on the query, filtered with threshold.
+        Returns a list of (output, distance), closest first, each answer at most once.
+        In hybrid mode keyword lookups are answered from the lexical index, see retrieve_hybrid.
+        '''
+        index = self.index
+        if self.retrieval == "hybrid":
+            hits = self.retrieve_hybrid(index, query, top_k, threshold)
+            return [(index.answer(answer_id), float(score)) for _, answer_id, score in hits]
+        vector = self.embed_model.embed_query(query)
+        with span("vector_search", top_k=top_k) as s:
+            hits = self.search_distinct(index, [vector], top_k, threshold)[0]
+            s.set(hits=len(hits))
+        return [(index.answer(answer_id), float(score)) for _, answer_id, score in hits]
+
+    def retrieve_docs_batch(self, queries: list, top_k: int=5, threshold: float=0.8):
+        '''
+        Retrieve for many queries at once: one bulk embedding call and one index search over all of them.
+        Always dense, whatever the retrieval mode.
+        Returns one dict per query with the "ids", "answer_ids", the "scores" (distances, closest first)
+        and the "outputs" of the hits below threshold, each answer at most once.
+        "ids" are row positions in the compact index (CompactIndex.output(id) is the row's answer),
+        not the docstore ids of the FAISS store.
+        '''
+        if not queries:
+            return []
+        # keep one index for the whole batch, refresh() may swap in another meanwhile
+        index = self.index
+        vectors = np.asarray(self.embed_model.embed_documents(list(queries)), dtype=np.float32)
+        with span("vector_search", top_k=top_k, queries=len(vectors)):
+            hits = self.search_distinct(index, vectors, top_k, threshold)
+        return [
+            {
+                "ids": [position for position, _, _ in query_hits],
+                "answer_ids": [answer_id for _, answer_id, _ in query_hits],
+                "scores": [score for _, _, score in query_hits],
+                "outputs": [index.answer(answer_id) for _, answer_id, _ in query_hits],
+            }
+            for query_hits in hits
+        ]
 
     def retrieve_docs(self,query:str, top_k:int =5, threshold:float= 0.8):
         '''
         Retrieve top k documents from the vector store based on the query.
         then filter with threshold.
         '''
-        docs = self.vector_store.similarity_search_with_score(query, top_k)
-
-        results = ""
-
-        for doc in docs:
-            if doc[1] < threshold:
-                results += f" {doc[0].metadata['output']}\n"
+        hits = self.retrieve_scored(query, top_k, threshold)
+        results = "".join(f" {output}\n" for output, _ in hits)
         ## if there are no results, we know that the query is not relevant
         return results if results else "NIL"
 
 # not class functions
+MANIFEST_NAME = "manifest.json"
+
+def iter_jsonl(path: str):
+    '''
+    Yield the input/output pairs from a jsonl file one at a time, skipping malformed lines.
+    '''
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping invalid line: {line.strip()} - Error: {e}")
+                continue  # Skip malformed lines
+
+def batched(items, size: int):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def row_hash(item: dict):
+    '''
+    Content hash of an input/output pair, identifies rows in the index manifest.
+    '''
+    return hashlib.sha256(f"{item['input']}\0{item['output']}".encode("utf-8")).hexdigest()
+
+def read_manifest(store_path: str):
+    '''
+    Manifest of the index: build id, hashes of the indexed rows and delta segments.
+    Returns None for stores saved without one.
+    '''
+    try:
+        with open(os.path.join(store_path, MANIFEST_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_manifest(store_path: str, manifest: dict):
+    path = os.path.join(store_path, MANIFEST_NAME)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(path + ".tmp", path)
+
+def manifest_mtime(store_path: str):
+    try:
+        return os.stat(os.path.join(store_path, MANIFEST_NAME)).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def compact_path(store_path: str, version: str):
+    return os.path.join(store_path, f"compact_{CompactIndex.FORMAT}_{version[:16]}")
+
+def export_compact(vector_store, store_path: str, version: str, index_type: str="flat"):
+    '''
+    Write the FAISS store as the compact index of this version, and remove compact indexes of older versions.
+    index_type: ANN index written along, see CompactIndex.write
+    Written aside and renamed into place, so concurrent readers and writers never see a partial index.
+    '''
+    path = compact_path(store_path, version)
+    tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    index = vector_store.index
+    ids = vector_store.index_to_docstore_id
+    docs = [vector_store.docstore.search(ids[i]) for i in range(index.ntotal)]
+    CompactIndex.write(tmp_path, index.reconstruct_n(0, index.ntotal), [d.metadata["output"] for d in docs], [d.page_content for d in docs], index_type)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process exported the same version first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    for name in os.listdir(store_path):
+        if name.startswith("compact_") and os.path.join(store_path, name) != path and ".tmp-" not in name:
+            shutil.rmtree(os.path.join(store_path, name), ignore_errors=True)
+
+def iter_pages(file_path: str):
+    '''
+    Yield the text of each page of the PDF, pages are only loaded when reached.
+    '''
+    import fitz
+
+    with fitz.open(file_path) as doc:
+        for page in doc:
+            yield page.get_text()
+
 def parse_pdf(file_path: str):
     '''
     Parse the PDF file and extract text from each page.
     '''
-    doc = fitz.open(file_path)
-    text = ""
-    for page in doc:
-        text += page.get_text()
+    text = "".join(iter_pages(file_path))
     print(text)
     return text
 
+def chunk_pages(pages, max_tokens: int=3000):
+    '''
+    Group page texts into chunks of at most max_tokens tokens, a page longer than that is split by lines.
+    pages: iterable of page texts, consumed lazily
+    '''
+    parts, size = [], 0
+    for page in pages:
+        for piece in split_text(page, max_tokens):
+            tokens = count_tokens(piece)
+            if parts and size + tokens > max_tokens:
+                yield "".join(parts)
+                parts, size = [], 0
+            parts.append(piece)
+            size += tokens
+    if parts:
+        yield "".join(parts)
+
+def split_text(text: str, max_tokens: int):
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    pieces, parts, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        tokens = count_tokens(line)
+        if parts and size + tokens > max_tokens:
+            pieces.append("".join(parts))
+            parts, size = [], 0
+        parts.append(line)
+        size += tokens
+    if parts:
+        pieces.append("".join(parts))
+    return pieces
+
 def generate_in_out_pairs(text :str):
     '''
     Generate input/output pairs in json format based on the text provided and write to a jsonl file.
@@ -85,14 +812,9 @@ def generate_in_out_pairs(text :str):
     count: the number of input/output pairs to generate
         optional, if not provided, count is determined by the model 
     '''
-    client = OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-    )
-
-
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
+    completion = get_client().complete(
         store=True,
+        call="ingest",
         messages=[
             {"role": "user", "content": 
              f"""You are an AI assistant tasked with generating question-answer pairs from a given text.
@@ -112,7 +834,7 @@ def generate_in_out_pairs(text :str):
             }
         ]
     )
-    data = json.loads(completion.choices[0].message.content.strip("```json"))
+    data = json.loads(completion.content.strip("```json"))
     return data
 
 def add_to_file(file_path: str, data: json):
@@ -131,20 +853,106 @@ def add_to_file(file_path: str, data: json):
               line: {item}""")
         return False
 
-def add_PDF_to_KnowledgeBase(file_path: str, data_path: str):
+def read_progress(progress_path: str):
+    try:
+        with open(progress_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def write_progress(progress_path: str, progress: dict):
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+def file_hash(file_path: str):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def generate_with_retry(text: str, retries: int=3, backoff: float=1.0):
+    '''
+    generate_in_out_pairs, retried with exponential backoff, returns None once all attempts failed.
+    '''
+    for attempt in range(retries):
+        try:
+            return generate_in_out_pairs(text)
+        except Exception as e:
+            print(f"Error generating pairs (attempt {attempt + 1}/{retries}): {e}")
+            if attempt + 1 < retries:
+                time.sleep(backoff * 2 ** attempt)
+    return None
+
+def ingest_pdf(file_path: str, data_path: str, max_tokens: int=3000, workers: int=4, retries: int=3):
+    '''
+    Generate input/output pairs for the PDF chunk by chunk and append them to data_path as each chunk finishes.
+    Chunks already written by an earlier run are skipped, so rerunning after a failure only redoes the failed chunks.
+
+    max_tokens: maximum number of tokens of PDF text sent in one request
+    workers: number of chunks processed in parallel
+    retries: attempts per chunk before it is left for the next run
+    returns (number of pairs added, number of chunks that failed)
+    '''
+    progress_path = data_path + ".ingest"
+    progress = read_progress(progress_path)
+    # chunk boundaries depend on max_tokens, so progress is kept per file and chunk size
+    key = f"{file_hash(file_path)}:{max_tokens}"
+    done = set(progress.get(key, []))
+    lock = threading.Lock()
+    added = 0
+    failed = 0
+
+    def finish(index: int, data):
+        nonlocal added, failed
+        with lock:
+            if data is None or not add_to_file(data_path, data):
+                failed += 1
+                return
+            added += len(data)
+            done.add(index)
+            progress[key] = sorted(done)
+            write_progress(progress_path, progress)
+
+    # at most 2 chunks per worker are held in memory, pages are read as the pool frees up
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for index, chunk in enumerate(chunk_pages(iter_pages(file_path), max_tokens)):
+            if index in done:
+                continue
+            future = pool.submit(generate_with_retry, chunk, retries)
+            future.add_done_callback(lambda f, index=index: finish(index, f.result()))
+            pending.add(future)
+            if len(pending) >= 2 * workers:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+        wait(pending)
+    return added, failed
+
+def add_PDF_to_KnowledgeBase(file_path: str, data_path: str, store_path: str="faiss_knowledge_base"):
     '''
     takes in a pdf file and generates input/output pairs
     then adds them to the knowledge base
+    only the new pairs are embedded and added to the existing index at store_path
     '''
-    pdf_text = parse_pdf(file_path)
-    data = generate_in_out_pairs(pdf_text)
-    if add_to_file(data_path, data):
-        print("Data added to file successfully.")
-    else:
-        print("Failed to add data to file.")
+    added, failed = ingest_pdf(
+        file_path,
+        data_path,
+        max_tokens=int(os.getenv("INGEST_CHUNK_TOKENS", "3000")),
+        workers=int(os.getenv("INGEST_WORKERS", "4")),
+    )
+    print(f"{added} pairs added to file.")
+    if failed:
+        print(f"{failed} chunks failed, run again to retry them.")
 
-    store = VectorStore(data_path)
-    print("Vector store updated")
+    if os.path.exists(os.path.join(store_path, "index.faiss")):
+        store = VectorStore(data_path, store_path, out_path=store_path)
+        added = store.update_vector_store(data_path)
+        print(f"Vector store updated, {added} new rows indexed")
+    else:
+        store = VectorStore(data_path, out_path=store_path)
+        print("Vector store created")
 
     return store
 
@@ -0,0 +1,79 @@
+'''
+Local booking intent classifier, decides the clear-cut cases without an LLM call.
+'''
+import re
+import threading
+
+from metrics import incr
+
+# (pattern, wants to book, confidence), checked in order, first match wins
+RULES = [
+    # negated or cancelling, e.g. "I don't want to book", "cancel my appointment"
+    # the negation must govern the booking verb, "I'm not sure, can I book for Monday?" is a wish to book
+    (r"\b(don'?t|do not|doesn'?t|does not|not|never|won'?t|no longer|no need)( (want|wanna|need|like|looking|going|trying|planning|wish))?( to)? (book|schedule|make|need|have|get)\b", False, 0.9),
+    (r"\bcancel", False, 0.9),
+    # questions about booking rules, e.g. "do I need to book in advance?"
+    (r"^(do|does|is|are) (i|we|you) (need|have|required) to\b", False, 0.85),
+    # asking how to book is a wish to book
+    (r"\bhow (do|can|could|would) (i|we)\b.*\b(book|schedule|set up|arrange)\b", True, 0.9),
+    (r"\b(want|would like|'d like|wanna|need|hoping|looking|trying) to (book|schedule|set up|arrange)\b", True, 0.95),
+    (r"\b(need|want|would like|'d like) (an|a|to have an|to have a) (appointment|booking)\b", True, 0.95),
+    (r"\b(make|set up|arrange) (an|a|my) (appointment|booking)\b", True, 0.9),
+    (r"\bget (an|a) (appointment|booking)\b", True, 0.9),
+    (r"\b(can|could|may) (i|we|you)\b.*\b(book|schedule|set up|arrange)\b", True, 0.9),
+    (r"^(please\s+)?(book|schedule)\b", True, 0.95),
+    (r"\b(book|schedule) (me|us|an|a|my|one)\b", True, 0.9),
+    # "make" and "get" are too broad to decide on, e.g. "can I make changes to my booking?",
+    # "how can I get to the clinic for my appointment?", left to the fallback
+    (r"\b(how (do|can|could|would)|can|could|may) (i|we|you)\b.*\b(make|get)\b", True, 0.6),
+    # other questions that only mention appointments, e.g. "how long does an appointment take?"
+    (r"^(how|what|when|where|why|which|who|is|are|does|do)\b", False, 0.85),
+]
+
+TRIGGER_WORDS = ["book", "appointment", "schedule"]
+
+class IntentClassifier:
+    def __init__(self, min_confidence: float = 0.8):
+        """
+        min_confidence: decisions below this confidence are left to the fallback
+        """
+        self.rules = [(re.compile(pattern), label, confidence) for pattern, label, confidence in RULES]
+        self.min_confidence = min_confidence
+        self.lock = threading.Lock()
+        self.local_decisions = 0
+        self.fallbacks = 0
+
+    def classify(self, text: str):
+        '''
+        Returns (wants to book, confidence).
+        '''
+        text = " ".join(text.lower().replace("’", "'").split())
+        if not any(word in text for word in TRIGGER_WORDS):
+            # bare "yes" and the like depend on the conversation, leave them to the fallback
+            return False, 0.5 if len(text.split()) <= 2 else 0.9
+        for pattern, label, confidence in self.rules:
+            if pattern.search(text):
+                return label, confidence
+        return False, 0.0
+
+    def check(self, text: str, fallback):
+        '''
+        Decide locally when confident, otherwise return fallback(text).
+        '''
+        label, confidence = self.classify(text)
+        if confidence >= self.min_confidence:
+            with self.lock:
+                self.local_decisions += 1
+            incr("intent_checks", decided="local")
+            return label
+        with self.lock:
+            self.fallbacks += 1
+        incr("intent_checks", decided="llm")
+        return fallback(text)
+
+    def fallback_rate(self):
+        total = self.local_decisions + self.fallbacks
+        return self.fallbacks / total if total else 0.0
+
+    def stats(self):
+        return {"local": self.local_decisions, "fallback": self.fallbacks, "fallback_rate": self.fallback_rate()}
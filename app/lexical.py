@@ -0,0 +1,172 @@
+'''
+Local BM25 inverted index over the knowledge base questions and answers, stored next to the
+compact vector index and read through mmap like it. Keyword lookups such as "phone number"
+or "Sunday" are answered from it without an embedding call, see VectorStore.retrieve_scored.
+'''
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+
+from cache import normalize_text
+
+# BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+# dropped from questions and queries, negations are kept since they change the meaning
+STOPWORDS = frozenset("""
+a about am an and any are as at be been being by can could did do does during for from get had has have
+how i if in into is it its me my of on or our please s should so tell than that the their them there
+they this to us was we were what when where which who whom why will with would you your
+""".split())
+
+def tokenize(text: str):
+    '''
+    Content terms of text: normalized words without stopwords, with a plural "s" stripped.
+    '''
+    terms = []
+    for word in normalize_text(text).split():
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+def text_key(text: str):
+    '''
+    64-bit hash of the normalized text, equal for questions that differ only in case and punctuation.
+    '''
+    return int.from_bytes(hashlib.blake2b(normalize_text(text).encode("utf-8"), digest_size=8).digest(), "little")
+
+class LexicalField:
+    '''
+    Postings of one field: for each term, the documents containing it and their term frequencies.
+    '''
+    def __init__(self, path: str, name: str, meta: dict):
+        self.docs = meta["docs"]
+        self.avgdl = meta["avgdl"]
+        # term -> (first posting, posting count)
+        self.terms = meta["terms"]
+        postings = meta["postings"]
+        # np.memmap cannot map an empty file
+        self.lengths = np.memmap(os.path.join(path, f"{name}.len"), dtype=np.uint32, mode="r", shape=(self.docs,)) if self.docs else np.zeros(0, np.uint32)
+        self.postings = np.memmap(os.path.join(path, f"{name}.post"), dtype=np.uint32, mode="r", shape=(postings,)) if postings else np.zeros(0, np.uint32)
+        self.tfs = np.memmap(os.path.join(path, f"{name}.tf"), dtype=np.uint16, mode="r", shape=(postings,)) if postings else np.zeros(0, np.uint16)
+        self._norms = None
+
+    @staticmethod
+    def write(path: str, name: str, texts: list):
+        '''
+        Write the postings of texts, one document each, returns the field's entry of lexical.json.
+        '''
+        index = {}
+        lengths = []
+        for doc, text in enumerate(texts):
+            terms = tokenize(text)
+            lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                index.setdefault(term, []).append((doc, min(count, 65535)))
+        terms = {}
+        postings, tfs = [], []
+        for term in sorted(index):
+            terms[term] = (len(postings), len(index[term]))
+            for doc, count in index[term]:
+                postings.append(doc)
+                tfs.append(count)
+        np.asarray(lengths, dtype=np.uint32).tofile(os.path.join(path, f"{name}.len"))
+        np.asarray(postings, dtype=np.uint32).tofile(os.path.join(path, f"{name}.post"))
+        np.asarray(tfs, dtype=np.uint16).tofile(os.path.join(path, f"{name}.tf"))
+        return {
+            "docs": len(texts),
+            "avgdl": sum(lengths) / len(lengths) if lengths else 0.0,
+            "postings": len(postings),
+            "terms": terms,
+        }
+
+    def idf(self, term: str):
+        entry = self.terms.get(term)
+        df = entry[1] if entry else 0
+        return math.log(1 + (self.docs - df + 0.5) / (df + 0.5))
+
+    @property
+    def norms(self):
+        # per document part of the BM25 denominator
+        if self._norms is None:
+            self._norms = K1 * (1 - B + B * np.asarray(self.lengths, dtype=np.float32) / (self.avgdl or 1))
+        return self._norms
+
+    def score(self, terms: list):
+        '''
+        Returns (BM25 scores, idf mass of the matched terms), one entry per document.
+        '''
+        scores = np.zeros(self.docs, dtype=np.float32)
+        matched = np.zeros(self.docs, dtype=np.float64)
+        for term in set(terms):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            start, count = entry
+            docs = self.postings[start:start + count]
+            tfs = self.tfs[start:start + count].astype(np.float32)
+            idf = self.idf(term)
+            scores[docs] += idf * tfs * (K1 + 1) / (tfs + self.norms[docs])
+            matched[docs] += idf
+        return scores, matched
+
+class LexicalIndex:
+    '''
+    BM25 over the questions (one document per row) and the answers (one document per answer id).
+    '''
+    def __init__(self, path: str):
+        with open(os.path.join(path, "lexical.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.input = LexicalField(path, "input", meta["input"])
+        self.output = LexicalField(path, "output", meta["output"])
+        # normalized question hash of each row, to spot a query that is a known question word for word
+        self.keys = np.memmap(os.path.join(path, "input.keys"), dtype=np.uint64, mode="r", shape=(self.input.docs,)) if self.input.docs else np.zeros(0, np.uint64)
+
+    @staticmethod
+    def write(path: str, inputs: list, answers: list):
+        '''
+        Write the lexical index of the rows' questions and of the distinct answers into the directory at path.
+        '''
+        meta = {
+            "input": LexicalField.write(path, "input", inputs),
+            "output": LexicalField.write(path, "output", answers),
+        }
+        np.asarray([text_key(text) for text in inputs], dtype=np.uint64).tofile(os.path.join(path, "input.keys"))
+        with open(os.path.join(path, "lexical.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    def search(self, query: str, answer_ids, output_weight: float = 0.0):
+        '''
+        Score every row against the query.
+        answer_ids: answer id of each row, the answer's score counts for all its rows
+        output_weight: weight of the answers' text next to the questions', 0 to search questions only
+        Returns (BM25 scores, coverage), coverage is the share of the query terms' idf a row matches, 0 to 1.
+        '''
+        terms = tokenize(query)
+        scores, matched = self.input.score(terms)
+        if output_weight and self.output.docs:
+            answer_scores, answer_matched = self.output.score(terms)
+            answer_ids = np.asarray(answer_ids)
+            scores += output_weight * answer_scores[answer_ids]
+            # the better matching field counts, a term found in both is not counted twice
+            matched = np.maximum(matched, output_weight * answer_matched[answer_ids])
+        # terms missing from the index count with the highest idf, a query about something unknown is not covered
+        total = sum(self.input.idf(term) for term in set(terms))
+        coverage = np.minimum(matched / total, 1.0) if total else matched
+        return scores, coverage
+
+    def exact(self, query: str):
+        '''
+        Rows whose question is the query after normalization.
+        '''
+        return np.nonzero(self.keys == np.uint64(text_key(query)))[0]
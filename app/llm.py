@@ -0,0 +1,472 @@
+'''
+Shared LLM client used by every chat completion call site.
+One long-lived client keeps HTTP keep-alive and TLS sessions across turns,
+and the backend can be swapped for a local deterministic stub in tests and benchmarks.
+Every call runs under the CallPolicy of its kind (deadline, bounded retries, hedging), and a circuit
+breaker fails calls fast while the upstream is degraded, callers then fall back to local answers.
+'''
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from dotenv import load_dotenv
+
+from metrics import incr
+from metrics import span
+
+load_dotenv()
+
+DEFAULT_MODEL = "gpt-4o-mini"
+
+_encoding = None
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL):
+    '''
+    Number of tokens in text for the model's tokenizer.
+    Falls back to about 4 characters per token when tiktoken cannot load its encoding, e.g. offline.
+    '''
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.encoding_for_model(model)
+        except Exception:
+            _encoding = False
+    if _encoding is False:
+        return (len(text) + 3) // 4
+    return len(_encoding.encode(text, disallowed_special=()))
+
+class LLMUnavailable(Exception):
+    '''
+    The call got no response within its deadline and retries, or the circuit breaker is open.
+    '''
+
+class CallPolicy:
+    def __init__(self, deadline: float = 20.0, retries: int = 1, backoff: float = 0.2, hedge: bool = False, hedge_after: float = None,
+                 attempt_timeout: float = None):
+        """
+        How long one kind of call may take and how hard it is tried.
+        deadline: seconds the whole call may take, retries and backoff included
+        retries: attempts after the first, on errors and timeouts, while the deadline allows
+        backoff: each wait between attempts is drawn between 0 and backoff * 2^(attempt - 1) seconds
+        hedge: fire a duplicate request once the first is slower than the p95 latency of this kind of call,
+            the first response wins
+        hedge_after: latest delay before hedging, also used until enough latencies are recorded for a p95,
+            keeps hedging on when slow requests are so frequent the p95 itself is slow
+            optional, if not provided, a quarter of the deadline
+        attempt_timeout: seconds before an attempt is given up and retried
+            optional, if not provided, an attempt may use all the time left before the deadline
+        """
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_after = hedge_after if hedge_after is not None else deadline / 4
+        self.attempt_timeout = attempt_timeout
+
+def policy_from_env(call: str, **defaults):
+    '''
+    CallPolicy for a kind of call, LLM_<CALL>_DEADLINE, LLM_<CALL>_RETRIES and LLM_<CALL>_ATTEMPT_TIMEOUT override the defaults,
+    LLM_HEDGE=0 turns hedging off.
+    '''
+    name = call.upper()
+    defaults["deadline"] = float(os.getenv(f"LLM_{name}_DEADLINE", defaults.get("deadline", 20.0)))
+    defaults["retries"] = int(os.getenv(f"LLM_{name}_RETRIES", defaults.get("retries", 1)))
+    if os.getenv(f"LLM_{name}_ATTEMPT_TIMEOUT"):
+        defaults["attempt_timeout"] = float(os.getenv(f"LLM_{name}_ATTEMPT_TIMEOUT"))
+    defaults["hedge"] = defaults.get("hedge", False) and os.getenv("LLM_HEDGE", "1") == "1"
+    return CallPolicy(**defaults)
+
+# kind of call -> policy, see LLMClient.complete
+POLICIES = {
+    # RAG answers shown to the user
+    "chat": policy_from_env("chat", deadline=20.0, retries=1, hedge=True),
+    # short classification and extraction calls of the booking flow
+    "intent": policy_from_env("intent", deadline=5.0, retries=1, hedge=True, attempt_timeout=3.0),
+    "slots": policy_from_env("slots", deadline=8.0, retries=1, hedge=True, attempt_timeout=5.0),
+    # offline PDF ingestion, long responses, generate_with_retry retries whole chunks itself
+    "ingest": policy_from_env("ingest", deadline=180.0, retries=0),
+}
+
+class CircuitBreaker:
+    def __init__(self, failures: int = 5, reset_after: float = 30.0):
+        """
+        Fails calls fast while the upstream is degraded, instead of every caller waiting out its deadline.
+        failures: consecutive failed attempts that open the circuit
+        reset_after: seconds the circuit stays open before one trial call is let through
+        """
+        self.failures = failures
+        self.reset_after = reset_after
+        self.lock = threading.Lock()
+        self.consecutive = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.trial or time.monotonic() - self.opened_at >= self.reset_after else "open"
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.reset_after:
+                # half open, its outcome closes or reopens the circuit
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.consecutive = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.consecutive += 1
+            if self.trial or self.consecutive >= self.failures:
+                if self.opened_at is None or self.trial:
+                    incr("llm_circuit_opened")
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+class Completion:
+    def __init__(self, content: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        self.content = content
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+
+class OpenAIBackend:
+    def __init__(self, timeout: float = 30.0, max_connections: int = 20, max_retries: int = 0):
+        """
+        Chat completions through the OpenAI API over one pooled HTTP client.
+        timeout: seconds before a request is abandoned, each call passes the time left before its deadline
+        max_connections: size of the HTTP connection pool
+        max_retries: retries done by the OpenAI SDK on connection errors and 5xx/429 responses
+            0 by default, LLMClient retries within each call's deadline
+        """
+        import httpx
+        from openai import OpenAI
+
+        self.client = OpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            timeout=timeout,
+            max_retries=max_retries,
+            http_client=httpx.Client(
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+                timeout=timeout,
+            ),
+        )
+
+    def complete(self, messages: list, model: str, **kwargs):
+        completion = self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+        usage = completion.usage
+        return Completion(
+            completion.choices[0].message.content,
+            usage.prompt_tokens if usage else 0,
+            usage.completion_tokens if usage else 0,
+        )
+
+    def stream(self, messages: list, model: str, **kwargs):
+        stream = self.client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+class StubBackend:
+    def __init__(self, responder=None, latency: float = 0.0, token_delay: float = 0.0, failure_rate: float = 0.0,
+                 slow_rate: float = 0.0, slow_latency: float = 0.0, seed: int = 0):
+        """
+        Deterministic local stand-in for the OpenAI backend, no network needed.
+        responder: function taking the messages and returning the response text
+            optional, if not provided, every call returns '{}'
+        latency: seconds to sleep per call, to simulate the provider round trip
+        token_delay: seconds between streamed tokens
+        failure_rate: share of calls that fail with ConnectionError after the latency
+        slow_rate, slow_latency: share of calls that take slow_latency instead of latency, a latency tail
+        seed: seed of the injected failures and slow calls
+        """
+        self.responder = responder if responder is not None else (lambda messages: json.dumps({}))
+        self.latency = latency
+        self.token_delay = token_delay
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def wait(self, timeout: float = None):
+        '''
+        Sleep for the call's latency and inject failures, a timeout cuts the sleep short like the SDK's request timeout.
+        '''
+        with self.lock:
+            self.requests += 1
+            fail = self.rng.random() < self.failure_rate
+            slow = self.rng.random() < self.slow_rate
+        latency = self.slow_latency if slow else self.latency
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"stub request timed out after {timeout:.2f}s")
+        if latency:
+            time.sleep(latency)
+        if fail:
+            raise ConnectionError("stub failure")
+
+    def complete(self, messages: list, model: str, timeout: float = None, **kwargs):
+        self.wait(timeout)
+        content = self.responder(messages)
+        # rough token counts, about 4 characters per token
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        if self.token_delay:
+            # same pacing as stream(), one delay between words
+            time.sleep(self.token_delay * content.count(" "))
+        return Completion(content, prompt_tokens, len(content) // 4)
+
+    def stream(self, messages: list, model: str, timeout: float = None, **kwargs):
+        self.wait(timeout)
+        # words stand in for tokens
+        for i, word in enumerate(self.responder(messages).split(" ")):
+            if i and self.token_delay:
+                time.sleep(self.token_delay)
+            yield word if i == 0 else " " + word
+
+class LLMClient:
+    def __init__(self, backend, max_concurrency: int = 16, policies: dict = None, breaker: CircuitBreaker = None):
+        """
+        backend: OpenAIBackend, StubBackend or any object with a matching complete()
+        max_concurrency: maximum number of requests in flight at once, further callers wait
+        policies: kind of call -> CallPolicy
+            optional, if not provided, POLICIES
+        breaker: circuit breaker shared by all calls
+            optional, if not provided, one opening after 5 consecutive failures for 30 seconds
+        """
+        self.backend = backend
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.policies = policies if policies is not None else POLICIES
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # requests run here so the caller can stop waiting at the deadline, hedges need a second thread
+        self.pool = ThreadPoolExecutor(max_workers=2 * max_concurrency, thread_name_prefix="llm")
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.requests = 0
+        self.retries = 0
+        self.hedges = 0
+        self.failures = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # kind of call -> latencies of its recent successful requests, for the hedging delay
+        self.latencies = {}
+
+    def policy(self, call: str):
+        return self.policies.get(call) or self.policies.get("chat") or CallPolicy()
+
+    def hedge_delay(self, call: str, policy: CallPolicy):
+        '''
+        p95 latency of the recent requests of this kind, at most policy.hedge_after, which is used until 20 are recorded.
+        '''
+        with self.lock:
+            recent = sorted(self.latencies.get(call, ()))
+        if len(recent) < 20:
+            return policy.hedge_after
+        return min(recent[int(0.95 * (len(recent) - 1))], policy.hedge_after)
+
+    def send(self, call: str, request, timeout: float):
+        '''
+        One request on a pool thread, its latency is recorded for the hedging delay.
+        '''
+        with self.slots:
+            start = time.monotonic()
+            result = request(timeout)
+            seconds = time.monotonic() - start
+        with self.lock:
+            self.latencies.setdefault(call, deque(maxlen=200)).append(seconds)
+        return result
+
+    def attempt(self, call: str, policy: CallPolicy, request, deadline: float):
+        '''
+        One attempt: the request, and a hedge fired after the p95 delay if the policy allows, first response wins.
+        Raises the request's error, or TimeoutError at the deadline or the policy's attempt timeout.
+        '''
+        start = time.monotonic()
+        if policy.attempt_timeout is not None:
+            deadline = min(deadline, start + policy.attempt_timeout)
+        with self.lock:
+            self.requests += 1
+        pending = {self.pool.submit(self.send, call, request, deadline - start)}
+        hedge_at = start + self.hedge_delay(call, policy) if policy.hedge else None
+        error = None
+        while pending:
+            now = time.monotonic()
+            wake = deadline if hedge_at is None else min(deadline, hedge_at)
+            if now >= deadline:
+                break
+            done, pending = wait(pending, timeout=max(wake - now, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    # the slower request keeps its pool thread until the backend returns, its result is dropped
+                    return future.result()
+                error = future.exception()
+            if hedge_at is not None and pending and time.monotonic() >= hedge_at:
+                hedge_at = None
+                with self.lock:
+                    self.requests += 1
+                    self.hedges += 1
+                incr("llm_hedges", call=call)
+                pending.add(self.pool.submit(self.send, call, request, deadline - time.monotonic()))
+        if pending or error is None:
+            raise TimeoutError(f"no response within {deadline - start:.1f}s")
+        raise error
+
+    def call(self, call: str, request):
+        '''
+        Run request(timeout) under the policy of the call: attempts until one succeeds, the retries run out
+        or the deadline passes, with jittered exponential backoff in between. Raises LLMUnavailable.
+        '''
+        policy = self.policy(call)
+        deadline = time.monotonic() + policy.deadline
+        error = None
+        for attempt in range(policy.retries + 1):
+            if attempt:
+                pause = random.uniform(0, policy.backoff * 2 ** (attempt - 1))
+                if time.monotonic() + pause >= deadline:
+                    break
+                time.sleep(pause)
+                with self.lock:
+                    self.retries += 1
+                incr("llm_retries", call=call)
+            if not self.breaker.allow():
+                incr("llm_failures", call=call, reason="circuit_open")
+                raise LLMUnavailable(f"{call}: circuit open after repeated failures")
+            try:
+                result = self.attempt(call, policy, request, deadline)
+            except Exception as e:
+                error = e
+                self.breaker.failure()
+                incr("llm_failures", call=call, reason=type(e).__name__)
+                if time.monotonic() >= deadline:
+                    break
+                continue
+            self.breaker.success()
+            return result
+        with self.lock:
+            self.failures += 1
+        raise LLMUnavailable(f"{call}: {error!r}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "requests": self.requests,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "failures": self.failures,
+                "circuit": self.breaker.state,
+            }
+
+    def record_tokens(self, prompt_tokens: int, completion_tokens: int):
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def complete(self, messages: list, model: str = DEFAULT_MODEL, call: str = "chat", **kwargs):
+        '''
+        Run a chat completion and return a Completion.
+        call: kind of call, picks its CallPolicy, e.g. "chat", "intent", "slots", "ingest"
+        Raises LLMUnavailable when it fails within its policy.
+        '''
+        with self.lock:
+            self.calls += 1
+        with span("llm_complete", model=model, call=call) as s:
+            completion = self.call(call, lambda timeout: self.backend.complete(messages, model, timeout=timeout, **kwargs))
+            s.set(prompt_tokens=completion.prompt_tokens, completion_tokens=completion.completion_tokens)
+        self.record_tokens(completion.prompt_tokens, completion.completion_tokens)
+        return completion
+
+    def stream(self, messages: list, model: str = DEFAULT_MODEL, usage: dict = None, call: str = "chat", **kwargs):
+        '''
+        Run a chat completion and yield the response text in chunks as they arrive.
+        usage: filled with "prompt_tokens" and "completion_tokens" once the response is complete
+        call: kind of call, see complete()
+        The policy covers the wait for the first chunk, raises LLMUnavailable before any chunk is yielded.
+        The concurrency slot is held until the first chunk, the rest of the response is read by the caller.
+        A failure after the first chunk counts against the circuit breaker and raises LLMUnavailable too,
+        the caller has to finish the partial answer.
+        '''
+        with self.lock:
+            self.calls += 1
+
+        def first_chunk(timeout):
+            iterator = iter(self.backend.stream(messages, model, timeout=timeout, **kwargs))
+            return iterator, next(iterator, None)
+
+        chunks = []
+        with span("llm_stream", model=model, call=call) as s:
+            iterator, chunk = self.call(call, first_chunk)
+            if chunk is not None:
+                chunks.append(chunk)
+                yield chunk
+            try:
+                for chunk in iterator:
+                    chunks.append(chunk)
+                    yield chunk
+            except Exception as e:
+                # connection reset or read timeout mid-response, too late to retry
+                self.breaker.failure()
+                incr("llm_failures", call=call, reason=type(e).__name__)
+                with self.lock:
+                    self.failures += 1
+                raise LLMUnavailable(f"{call}: stream interrupted: {e!r}") from e
+            # streamed responses carry no usage, count the tokens locally
+            prompt_tokens = sum(count_tokens(m["content"], model) for m in messages)
+            completion_tokens = count_tokens("".join(chunks), model)
+            s.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        self.record_tokens(prompt_tokens, completion_tokens)
+        if usage is not None:
+            usage.update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    '''
+    Return the process-wide client, created on first use from the environment:
+    LLM_BACKEND ("openai" or "stub"), LLM_TIMEOUT, LLM_MAX_CONNECTIONS, LLM_MAX_CONCURRENCY,
+    LLM_BREAKER_FAILURES, LLM_BREAKER_RESET, and the per-call overrides of policy_from_env
+    '''
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if os.getenv("LLM_BACKEND", "openai") == "stub":
+                    backend = StubBackend()
+                else:
+                    backend = OpenAIBackend(
+                        timeout=float(os.getenv("LLM_TIMEOUT", "30")),
+                        max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+                    )
+                _client = LLMClient(
+                    backend,
+                    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+                    breaker=CircuitBreaker(
+                        failures=int(os.getenv("LLM_BREAKER_FAILURES", "5")),
+                        reset_after=float(os.getenv("LLM_BREAKER_RESET", "30")),
+                    ),
+                )
+    return _client
+
+def set_client(client):
+    '''
+    Replace the process-wide client, e.g. with LLMClient(StubBackend(...)) in tests and benchmarks.
+    '''
+    global _client
+    _client = client
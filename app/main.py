@@ -1,245 +1,307 @@
-from openai import OpenAI
 import os
 from dotenv import load_dotenv
-from index import VectorStore
+from llm import count_tokens
+from llm import LLMUnavailable
+from llm import get_client
+from cache import LRUCache
+from cache import normalize_text
+from intent import IntentClassifier
+from metrics import incr
+from metrics import record
+from metrics import span
+from metrics import tracer
+from slots import SlotFiller
 from booking import Booking
 from booking import Bookings
+from booking import SqliteStore
+from booking import calendar_from_env
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
 import json
 import datetime
+import time as timer
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # index pulls in langchain, it is imported on the background loader thread instead, see open_store
+    from index import VectorStore
 
 load_dotenv()
 
-def generate_response_w_RAG(store: VectorStore, prompt):
+# top hit closer than this distance is a near-identical known question, its stored answer is returned as is
+DIRECT_ANSWER_THRESHOLD = float(os.getenv("RAG_DIRECT_THRESHOLD", "0.05"))
+# final responses keyed by normalized query and knowledge base version
+response_cache = LRUCache(
+    maxsize=int(os.getenv("RAG_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("RAG_CACHE_TTL", "3600")),
+)
 
-    client = OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-    )
+# print RAG answers token by token as they arrive
+STREAM_RESPONSES = os.getenv("RAG_STREAM", "1") == "1"
 
-    rejection_message = "Sorry, I don't have enough information to answer that question. Please contact us at BrightSmile Dental Clinic for more information."
+# clear-cut booking intents are decided locally, the rest go to booking_trigger_check
+intent_classifier = IntentClassifier(float(os.getenv("INTENT_MIN_CONFIDENCE", "0.8")))
+# booking details are parsed locally when possible, otherwise with one LLM call per turn
+slot_filler = SlotFiller()
 
-    rag_results = store.retrieve_docs(prompt)
-    # print("Results from vector store: ", rag_results)
-    if rag_results == "NIL":
-        return rejection_message
-    
-    #refine the prompt
-    dev_prompt = f"""
+rejection_message = "Sorry, I don't have enough information to answer that question. Please contact us at BrightSmile Dental Clinic for more information."
+
+# token budget for the retrieved answers sent with each question
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "1000"))
+
+# sent first and byte-identical on every turn, so the provider can cache this prompt prefix,
+# the retrieved context follows in its own message
+RAG_INSTRUCTIONS = f"""
                     You are a helpful assistant for BrightSmile Dental Clinic. Your job is to help answer questions about the clinic and to set up appointments. 
                     When answering questions, use only what is provided in the context, do not infer, generalize, or assume any information. 
                     If no relavant information is provided, respond with '{rejection_message}'
-                    Context: {rag_results}
                     """
-    
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        store=True,
-        messages = [
-            {"role": "developer", "content": dev_prompt},
-            {"role": "user", "content": prompt}
-        ]
-    )
 
-    response = completion.choices[0].message.content
+# time to first token, total generation time and token usage of recent answers
+response_timings = deque(maxlen=1000)
+
+def record_timing(start, first_token, end, llm_call, prompt_tokens=0, completion_tokens=0, usage=None):
+    '''
+    usage: per-conversation totals, "prompt_tokens", "completion_tokens" and "answers" are added to it
+    '''
+    response_timings.append({
+        "ttft": first_token - start,
+        "total": end - start,
+        "llm_call": llm_call,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+    })
+    record("rag_answer", end - start, ttft_ms=round((first_token - start) * 1000, 3), llm_call=llm_call,
+           prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    incr("rag_tokens", prompt_tokens, kind="prompt")
+    incr("rag_tokens", completion_tokens, kind="completion")
+    if usage is not None:
+        usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + prompt_tokens
+        usage["completion_tokens"] = usage.get("completion_tokens", 0) + completion_tokens
+        usage["answers"] = usage.get("answers", 0) + 1
+
+def pack_context(hits: list, budget: int = None):
+    '''
+    The retrieved answers that fit in the token budget, taken closest first.
+    hits: (output, distance) pairs from VectorStore.retrieve_scored
+    '''
+    if budget is None:
+        budget = CONTEXT_TOKENS
+    parts = []
+    for output, _ in hits:
+        part = f" {output}\n"
+        tokens = count_tokens(part)
+        # an answer too long for what is left is skipped, a shorter one further down may still fit
+        if tokens <= budget:
+            parts.append(part)
+            budget -= tokens
+    return "".join(parts)
+
+def prepare_RAG(store: "VectorStore", prompt, direct_threshold: float = None):
+    '''
+    Returns (cache_key, response, messages, fallback), response is set when the answer needs no LLM call,
+    otherwise messages holds the completion request, and fallback the closest stored answer
+    to reply with if the LLM is unavailable.
+    '''
+    if direct_threshold is None:
+        direct_threshold = DIRECT_ANSWER_THRESHOLD
+    cache_key = (normalize_text(prompt), store.version)
+    response = response_cache.get(cache_key)
+    if response is not None:
+        incr("rag_answers", source="cache")
+        return cache_key, response, None, None
+
+    hits = store.retrieve_scored(prompt)
+    # print("Results from vector store: ", hits)
+    if not hits:
+        incr("rag_answers", source="rejected")
+        response_cache.put(cache_key, rejection_message)
+        return cache_key, rejection_message, None, None
+    if hits[0][1] < direct_threshold:
+        incr("rag_answers", source="direct")
+        response_cache.put(cache_key, hits[0][0])
+        return cache_key, hits[0][0], None, None
+    incr("rag_answers", source="llm")
+    rag_results = pack_context(hits)
+
+    messages = [
+        {"role": "developer", "content": RAG_INSTRUCTIONS},
+        {"role": "developer", "content": f"Context: {rag_results}"},
+        {"role": "user", "content": prompt}
+    ]
+    return cache_key, None, messages, hits[0][0]
+
+def fallback_answer(fallback: str, error: Exception):
+    '''
+    Local answer when the LLM is unavailable: the closest stored answer, not cached so the LLM answers again once it recovers.
+    '''
+    print("Error in OpenAI API call: ", error)
+    incr("rag_answers", source="fallback")
+    return fallback or rejection_message
+
+def generate_response_w_RAG(store: "VectorStore", prompt, direct_threshold: float = None, usage: dict = None):
+    start = timer.perf_counter()
+    cache_key, response, messages, fallback = prepare_RAG(store, prompt, direct_threshold)
+    if response is not None:
+        end = timer.perf_counter()
+        record_timing(start, end, end, False, usage=usage)
+        return response
+
+    try:
+        completion = get_client().complete(store=True, messages=messages, call="chat")
+    except LLMUnavailable as e:
+        end = timer.perf_counter()
+        record_timing(start, end, end, True, usage=usage)
+        return fallback_answer(fallback, e)
+
+    response = completion.content
+    response_cache.put(cache_key, response)
+    end = timer.perf_counter()
+    record_timing(start, end, end, True, completion.prompt_tokens, completion.completion_tokens, usage)
     return response
 
+def stream_response_w_RAG(store: "VectorStore", prompt, direct_threshold: float = None, usage: dict = None):
+    '''
+    Like generate_response_w_RAG, but yields the answer in chunks as the tokens arrive.
+    Answers that need no LLM call (cached, direct, rejected) are yielded at once.
+    '''
+    start = timer.perf_counter()
+    cache_key, response, messages, fallback = prepare_RAG(store, prompt, direct_threshold)
+    if response is not None:
+        end = timer.perf_counter()
+        record_timing(start, end, end, False, usage=usage)
+        yield response
+        return
+
+    chunks = []
+    first_token = None
+    tokens = {}
+    try:
+        for chunk in get_client().stream(store=True, messages=messages, usage=tokens, call="chat"):
+            if first_token is None:
+                first_token = timer.perf_counter()
+            chunks.append(chunk)
+            yield chunk
+    except LLMUnavailable as e:
+        end = timer.perf_counter()
+        record_timing(start, first_token or end, end, True, usage=usage)
+        if chunks:
+            # the stream broke off mid-answer, the partial answer stays and the stored one follows
+            yield "\n" + fallback_answer(fallback, e)
+        else:
+            yield fallback_answer(fallback, e)
+        return
+    end = timer.perf_counter()
+    record_timing(start, first_token or end, end, True, tokens.get("prompt_tokens", 0), tokens.get("completion_tokens", 0), usage)
+    response_cache.put(cache_key, "".join(chunks))
+
+def verify_date(date, curr_date, bookings: Bookings):
+    # check if the date is in the future and the clinic is open on it, see Bookings.opening_mask
+    try:
+        date_obj = datetime.datetime.strptime(date, "%Y-%m-%d").date()
+        date_day = date_obj.strftime("%A")
+        if date_obj < curr_date:
+            return False, "Sorry, the date you provided is in the past. Please choose a future date."
+        elif date in bookings.holidays:
+            return False, f"Sorry, we are closed on {date}. {suggest_slots(bookings, date)}"
+        elif not bookings.opening_mask(date_obj):
+            return False, f"Sorry, we are closed on {date_day}s. {suggest_slots(bookings, date)}"
+        else:
+            return True,  "date available"
+    except Exception as e:
+        print("Error parsing date: ", e)
+        return False, e
+
+def format_hour(hour):
+    # Convert to 12hr format in str
+    return str(hour) + " AM" if hour < 12 else str(hour - 12) + " PM"
+
+def suggest_slots(bookings: Bookings, date: str, count: int = 3):
+    '''
+    Offer the first free slots of the next days after a date that has none, so the user can pick one in a single turn.
+    '''
+    start = datetime.datetime.strptime(date, "%Y-%m-%d").date() + datetime.timedelta(days=1)
+    slots = bookings.next_available_slots(start, count, per_day=1)
+    if not slots:
+        return "Please choose another date."
+    options = ", ".join(
+        f"{datetime.datetime.strptime(day, '%Y-%m-%d').strftime('%A')} {day} at {format_hour(hour)}" for day, hour in slots
+    )
+    return f"The next available slots are {options}. Please choose one of them or another date."
+
 def process_booking(Bookings: Bookings):
 
     now = datetime.datetime.now()
-    curr_date, curr_day  = now.date(), now.strftime("%A")
+    curr_date = now.date()
 
-    def parse_input(input : str, input_type:str):
-        # parse the name and time from the input
-        client = OpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-        )
-        if input_type == "time":
-            message = f"""
-                        Given the provided input, extract the time of day.
-                        Respond strictly in the following JSON format: {{"time": "HH"}}
-                        - If no am or pm is indicated, assume the time falls between 9 AM and 5 PM.
-                        - The time should be represented as a number between 0 and 23 (24-hour format, without minutes).
-                        - If the input does not contain a valid or inferable time, set the value to false.
-                        - Do not include any explanation or additional text in your response.
-
-                        User input: "{input}"
-                        """
-
-            # message = f"""Extract the time from the following input, return the output in this format {{"time": "HH"}} 
-            #             and nothing else. The time should be a number between 0-23. If time is not provided or cannot be 
-            #             accurately derived, return false in place of the value.
-            #             User input: "{input}"
-            # #             """
-        elif input_type == "name":
-            message = f"""
-                        Given the user's input, extract the user's name.
-                        Respond strictly in the following JSON format: {{"name": "name"}}
-
-                        - If either the name cannot be confidently determined, set its value to false.
-
-                        User input: "{input}"
-                        """
-        elif input_type == "date":
-            message = f"""
-                        Given the user's input, extract the user's date of the appointment.
-                        Respond strictly in the following JSON format:: {{"date": "YYYY-MM-DD"}}.
-                        
-                        - consider that inputs might be in DD/M
-                        - If the date is incomplete or relative (e.g. "next Friday"), infer the full date based on today's date: {curr_date} ({curr_day}).
-                        - The derived date must be strictly after {curr_date}.
-                        - If the date cannot be confidently determined, set its value to false.
-
-                        User input: "{input}"
-                        """
-        elif input_type == "name_date":
-
-            message = f"""
-                        Given the user's input, extract the user's name and selected date of the appointment.
-                        Respond strictly in the following JSON format: {{"name": "name", "date": "YYYY-MM-DD"}}
-                        
-                        - consider that inputs might be in DD/M
-                        - If the date is incomplete or relative (e.g. "next Friday"), infer the full date based on today's date: {curr_date} ({curr_day}).
-                        - The derived date must be strictly after {curr_date}.
-                        - If either the name or date cannot be confidently determined, set its value to false.
-
-                        User input: "{input}"
-                        """
-
-        try:
-            completion = client.chat.completions.create(
-                model="gpt-4o-mini",
-                store=True,
-                messages = [
-                    {"role": "system", "content": "You are an assistant that extracts structured information from natural language."},
-                    {"role": "user", "content": message},
-                ]
-            )
-        
-            response = json.loads(completion.choices[0].message.content.strip("```json"))
-            
-
-        except Exception as e:
-            print("Error in OpenAI API call: ", e)
-            # print("Response from OpenAI: ", completion.choices[0].message.content)
-            if input_type == "name" or input_type == "date" or input_type == "time":
-                return False
-            else:
-                return False, False
-        # print("Response from OpenAI: ", response)
-        # parse the response
-        if input_type == "time":
-            try:
-                time = response["time"] 
-                return time
-            except Exception as e:
-                print("Error parsing response: ", e)
-                return False
-            
-        if input_type == "name":
-            try:
-                name = response["name"]
-                return name
-            except Exception as e:
-                print("Error parsing response: ", e)
-                return False
-        elif input_type == "date":
-            try:
-                date = response["date"]
-                return date
-            except Exception as e:
-                print("Error parsing response: ", e)
-                return False
-        elif input_type == "name_date":
-            try:
-                name = response["name"]
-                date = response["date"]
-                
-                return name, date
-            except Exception as e:
-                print("Error parsing response: ", e)
-                return False, False
-    
-
-    def verify_date(date):
-        # check if the date is in the future
-        try:
-            date_obj = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-            date_day = date_obj.strftime("%A")
-            if date_obj < curr_date:
-                return False, "Sorry, the date you provided is in the past. Please choose a future date."
-            elif date_day == "Sunday":
-                return False, "Sorry, we are closed on Sundays."
-            else:
-                return True,  "date available"
-        except Exception as e:
-            print("Error parsing date: ", e)
-            return False, e
+    def check_date(slots):
+        # reset the date if it cannot be booked
+        if slots.date is False:
+            return
+        verf, message = verify_date(slots.date, curr_date, Bookings)
+        if not verf:
+            print("--" * 40)
+            print(f"Assistant: {message}")
+            slots.date = False  # Reset date
 
-    name = False
-    date = False
-    time = False
+    # name, date and time are collected as slots, every turn fills whatever the user provides
+    # and only the missing slots are asked for
+    slots = slot_filler.new_booking(curr_date)
 
     # get name, date, time and remarks
-    # add error handling
     print("--" * 40)
     print("Assistant: Please tell me your name and preferred date.")
     name_date_input = input("You: ").strip()
     if name_date_input != "":
-        name, date = parse_input(name_date_input, "name_date")
-        verf, message = verify_date(date)
-        if not verf:
-            print("--" * 40)
-            print(f"Assistant: {message}")
-            date = False  # Reset date
-            
-    # name loop
-    while name == False:
-        print("--" * 40)
-        print("Assistant: Sorry, I didn't get your name. Could you repeat it?")
-        name_input = input("You: ")
-        
-        name = parse_input(name_input, "name")
+        slot_filler.fill(name_date_input, slots, ["name", "date"])
+        check_date(slots)
 
-    # Date loop - keep asking until we get a valid date with available slots
+    # Date loop - keep asking until we get a name and a valid date with available slots
     date_found = False
     while not date_found:
-        # First, ensure we have a valid date
-        while date == False:
+        while slots.name is False or slots.date is False:
+            missing = [slot for slot in ["name", "date"] if getattr(slots, slot) is False]
             print("--" * 40)
-            print("Assistant: Can I have your preferred date for the appointment.")
-            date_input = input("You: ").strip().lower()
-            if date_input == "":
-                print("Assistant: Please provide a valid date.")
+            if missing == ["name"]:
+                print("Assistant: Sorry, I didn't get your name. Could you repeat it?")
+            elif missing == ["date"]:
+                print("Assistant: Can I have your preferred date for the appointment.")
+            else:
+                print("Assistant: Can I have your name and preferred date for the appointment.")
+            slot_input = input("You: ").strip()
+            if slot_input == "":
+                print("Assistant: Please provide a valid " + " and ".join(missing) + ".")
                 continue
-            
-            date = parse_input(date_input, "date")
-            if date == False:
+
+            filled = slot_filler.fill(slot_input, slots, missing)
+            if missing == ["date"] and "date" not in filled:
                 print("Assistant: Sorry, I didn't get the date. Please try again.")
-                continue
-            verf, message = verify_date(date)
-            if not verf:
-                print("--" * 40)
-                print(f"Assistant: {message}")
-                date = False  # Reset date
-                continue
+            check_date(slots)
 
         # Now check if the date has available slots
-        avail = Bookings.get_available_slots(date)
-        if len(avail) > 0:
-            date_found = True
-        else:
+        avail = Bookings.get_available_slots(slots.date)
+        if len(avail) == 0:
             print("--" * 40)
-            print(f"Assistant: Sorry, there are no available slots for {date}. Please choose another date.")
-            date = False  # Reset date 
+            print(f"Assistant: Sorry, there are no available slots for {slots.date}. {suggest_slots(Bookings, slots.date)}")
+            slots.date = False  # Reset date 
             continue
-    
+
+        # a time given along with the date, e.g. "next Tuesday at 3pm"
+        if slots.time is not False:
+            if int(slots.time) in avail:
+                date_found = True
+                break
+            print("--" * 40)
+            print("Assistant: Sorry, the time you selected is not available. Please choose another time slot.")
+            slots.time = False
+
         # Time slot selection loop
-        time_selected = False
-        while not time_selected:
-            # Convert to 12hr format in str
-            avail_str = [str(i) + " AM" if i < 12 else str(i - 12) + " PM" for i in avail]
+        while slots.time is False:
+            avail_str = [format_hour(i) for i in avail]
             # Format output in 2 columns
             print("--" * 40)
-            print(f"Here are the available time slots for {date}:")
+            print(f"Here are the available time slots for {slots.date}:")
             for i in range(0, len(avail_str), 2):
                 if i + 1 < len(avail_str):
                     print(f"{avail_str[i]:<15} | {avail_str[i + 1]:<15}") 
@@ -255,27 +317,28 @@ def process_booking(Bookings: Bookings):
                 
             if time_input == "back" or time_input == "go back" or time_input == "cancel":
                 # Reset date selection to try another date
-                date = False
-                date_found = False
+                slots.date = False
                 # Go back to date selection loop
                 break
-                
-            # Parse the time
-            parsed_time = parse_input(time_input, "time")
-            if parsed_time == False or parsed_time == "False":
+
+            date = slots.date
+            filled = slot_filler.fill(time_input, slots, ["time"])
+            if slots.date != date:
+                # the user picked another date instead, check its availability first
+                check_date(slots)
+                break
+            if "time" not in filled:
                 print("Assistant: Sorry, I didn't get the time. Please try again.")
                 continue
             # Check if the time is valid
-            if int(parsed_time) in avail:
-                time_selected = True
-                time = int(parsed_time)
+            if int(slots.time) in avail:
+                date_found = True
             else:
                 print("Assistant: Sorry, the time you selected is not available. Please choose another time slot.")
-        
-        # # If we went back to date selection, restart the date loop
-        # if not time_selected:
-        #     continue
-    time_12hr = str(time) + " AM" if time < 12 else str(time - 12) + " PM"
+                slots.time = False
+
+    name, date, time = slots.name, slots.date, int(slots.time)
+    time_12hr = format_hour(time)
     print(f"Assistant: Got it! {name}, Your appointment will be on {date} at {time_12hr}.")
 
     print("--" * 40)
@@ -295,13 +358,15 @@ def process_booking(Bookings: Bookings):
     if confirm == "yes" or confirm == "y" or confirm == "confirm":
         # save the booking
         b1 = Booking(name,date,time,remarks)
-        if Bookings.add_booking(b1):
+        if Bookings.reserve_slot(b1):
             if Bookings.save_bookings():
+                slot_filler.complete(slots)
                 print("--" * 40)
                 print("Assistant: Your booking has been successfully made.")
                 
         else:
-            print("Error making booking.")
+            print("--" * 40)
+            print(f"Assistant: Sorry, the {time_12hr} slot on {date} has just been taken. Please try booking again.")
             
         
     else:
@@ -315,9 +380,6 @@ def process_booking(Bookings: Bookings):
     
 def booking_trigger_check(input):
     # use openAI to determine if the input is a booking trigger
-    client = OpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-    )
     message = f"""
                 You are a helpful assistant for BrightSmile Dental Clinic. Your job is to help answer questions about the clinic and to set up appointments.
 
@@ -327,23 +389,51 @@ def booking_trigger_check(input):
                 User input: "{input}"
                 """
     try:
-        completion = client.chat.completions.create(
-            model="gpt-4o-mini",
+        completion = get_client().complete(
             store=True,
+            call="intent",
             messages = [
                 {"role": "user", "content": message},
             ]
         )
     
-        response = json.loads(completion.choices[0].message.content.strip("```json"))
+        with span("parse_json", call="booking_trigger_check"):
+            response = json.loads(completion.content.strip("```json"))
         return response["trigger"]
+    except LLMUnavailable as e:
+        print("Error in OpenAI API call: ", e)
+        # the local classifier's best guess, even below its confidence threshold
+        return intent_classifier.classify(input)[0]
     except Exception as e:
         print("Error in OpenAI API call: ", e)
         # print("Response from OpenAI: ", completion.choices[0].message.content)
         return False
 
-def chat_loop(bookings : Bookings, store: VectorStore):
+def is_booking_request(prompt):
+    # Check if input contanins any booking triggers, then verify the intent
     booking_triggers = ["book", "appointment", "schedule"]
+    if any(trigger in prompt.lower() for trigger in booking_triggers) or prompt.lower() == "yes":
+        return intent_classifier.check(prompt, booking_trigger_check)
+    return False
+
+def load_in_background(load, *args, **kwargs):
+    '''
+    Run load(*args, **kwargs) on a background thread, returns a Future of its result.
+    '''
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(load, *args, **kwargs)
+    executor.shutdown(wait=False)
+    return future
+
+def open_store(data_path: str, store_path: str):
+    from index import VectorStore
+
+    return VectorStore(data_path, store_path)
+
+def chat_loop(bookings : Bookings, store: "VectorStore"):
+    '''
+    bookings, store: may be Futures still loading in the background, they are waited for after the first input
+    '''
     print("--" * 40)
     print("Welcome to BrightSmile Dental Clinic!")
     print("I am your virtual assistant. I can help you with your queries and set up appointments.")
@@ -353,27 +443,49 @@ def chat_loop(bookings : Bookings, store: VectorStore):
         prompt = input("You: ")
         if prompt.lower() == "exit":
             break
-
-        # Check if input contanins any booking triggers
-        if any(trigger in prompt.lower() for trigger in booking_triggers) or prompt.lower() == "yes":
-            if booking_trigger_check(prompt):
-                print("--" * 40)
-                print("Assistant: It seems like you want to book an appointment. Let me help you with that.")
+        if isinstance(bookings, Future):
+            bookings = bookings.result()
+        if isinstance(store, Future):
+            store = store.result()
+        # pick up knowledge base updates made by add_PDF_to_KnowledgeBase in another process
+        store.refresh()
+
+        if is_booking_request(prompt):
+            print("--" * 40)
+            print("Assistant: It seems like you want to book an appointment. Let me help you with that.")
+            with span("booking_dialogue"):
                 process_booking(bookings)
-                continue
+            continue
         
 
-        response = generate_response_w_RAG(store, prompt)
         print("--" * 40)
-        print("Assistant:", response)
+        with span("turn", state="qa"):
+            if STREAM_RESPONSES:
+                print("Assistant:", end=" ", flush=True)
+                for chunk in stream_response_w_RAG(store, prompt):
+                    print(chunk, end="", flush=True)
+                print()
+            else:
+                response = generate_response_w_RAG(store, prompt)
+                print("Assistant:", response)
 
 def main():
     bookings_file = "bookings_sample.csv"
-    bookings = Bookings(bookings_file)
+    bookings_db = os.getenv("BOOKINGS_DB")
+    # bookings and the index load in the background while the greeting is shown
+    if bookings_db:
+        # shared SQLite store, lets several chat workers take bookings without double-booking
+        bookings = load_in_background(Bookings, store=SqliteStore(bookings_db, seed_path=bookings_file), **calendar_from_env())
+    else:
+        # confirmed bookings are appended to a journal, and folded back into the csv on exit
+        bookings = load_in_background(Bookings, bookings_file, journal=True, **calendar_from_env())
     data_path = "data.jsonl"
     store_path = "faiss_knowledge_base"
-    store = VectorStore(data_path, store_path)
+    store = load_in_background(open_store, data_path, store_path)
     chat_loop(bookings, store)
+    bookings.result().compact()
+    if tracer.enabled:
+        tracer.write_prometheus("metrics.prom")
     return
     
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+'''
+Lightweight tracing and metrics for the chat, retrieval and booking stages.
+Off unless TRACE=1, span() then returns a shared no-op and incr() returns at once.
+When on, every finished span is written as a JSON line to TRACE_FILE (default "trace.jsonl"),
+and spans and counters are aggregated for a Prometheus text snapshot (GET /metrics in server mode).
+
+    with span("vector_search", top_k=5) as s:
+        hits = ...
+        s.set(hits=len(hits))
+'''
+import json
+import os
+import threading
+import time
+
+# upper bounds in seconds of the span duration histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Span:
+    __slots__ = ("tracer", "name", "attrs", "start")
+
+    def __init__(self, tracer, name: str, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = 0.0
+
+    def set(self, **attrs):
+        '''
+        Attach attributes known only once the work is done, e.g. token counts or cache hits.
+        '''
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.finish(self.name, seconds, self.attrs)
+        return False
+
+class NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = NoopSpan()
+
+class Tracer:
+    def __init__(self, enabled: bool = False, path: str = None):
+        """
+        enabled: record spans and counters
+        path: JSON lines file every finished span is appended to
+            optional, if not provided, spans are only aggregated
+        """
+        self.enabled = enabled
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+        # span name -> [count, total seconds, cumulative bucket counts]
+        self.spans = {}
+        # (counter name, sorted label items) -> value
+        self.counters = {}
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, attrs)
+
+    def incr(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def finish(self, name: str, seconds: float, attrs: dict):
+        line = json.dumps({"ts": time.time(), "span": name, "ms": round(seconds * 1000, 3), **attrs}, default=str)
+        with self.lock:
+            stats = self.spans.get(name)
+            if stats is None:
+                stats = self.spans[name] = [0, 0.0, [0] * len(BUCKETS)]
+            stats[0] += 1
+            stats[1] += seconds
+            buckets = stats[2]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            if self.path:
+                if self.file is None:
+                    # line buffered, each span is on disk once written
+                    self.file = open(self.path, "a", encoding="utf-8", buffering=1)
+                self.file.write(line + "\n")
+
+    def prometheus(self):
+        '''
+        Snapshot of the spans and counters in the Prometheus text format.
+        '''
+        lines = []
+        with self.lock:
+            if self.spans:
+                lines.append("# TYPE chatbot_span_seconds histogram")
+            for name, (count, total, buckets) in sorted(self.spans.items()):
+                for bound, bucket in zip(BUCKETS, buckets):
+                    lines.append(f'chatbot_span_seconds_bucket{{span="{name}",le="{bound}"}} {bucket}')
+                lines.append(f'chatbot_span_seconds_bucket{{span="{name}",le="+Inf"}} {count}')
+                lines.append(f'chatbot_span_seconds_sum{{span="{name}"}} {total:.6f}')
+                lines.append(f'chatbot_span_seconds_count{{span="{name}"}} {count}')
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE chatbot_{name}_total counter")
+                    typed.add(name)
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"chatbot_{name}_total{{{label_text}}} {value}" if labels else f"chatbot_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str):
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(path + ".tmp", path)
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.counters.clear()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+tracer = Tracer(os.getenv("TRACE", "0") == "1", os.getenv("TRACE_FILE", "trace.jsonl"))
+
+def span(name: str, **attrs):
+    '''
+    Time a stage: `with span("name", key=value) as s: ...`, a no-op while tracing is off.
+    '''
+    return tracer.span(name, **attrs)
+
+def record(name: str, seconds: float, **attrs):
+    '''
+    Record a span timed by the caller, a no-op while tracing is off.
+    '''
+    if tracer.enabled:
+        tracer.finish(name, seconds, attrs)
+
+def incr(name: str, value: float = 1, **labels):
+    '''
+    Add to a counter, a no-op while tracing is off.
+    '''
+    tracer.incr(name, value, **labels)
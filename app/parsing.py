@@ -0,0 +1,280 @@
+'''
+Deterministic parsing of booking inputs (dates, times, names), tried before asking the LLM.
+Every parser returns None when it cannot resolve the input, the caller then falls back to the LLM.
+'''
+import datetime
+import re
+
+MONTHS = {
+    "january": 1, "jan": 1, "february": 2, "feb": 2, "march": 3, "mar": 3, "april": 4, "apr": 4,
+    "may": 5, "june": 6, "jun": 6, "july": 7, "jul": 7, "august": 8, "aug": 8,
+    "september": 9, "sept": 9, "sep": 9, "october": 10, "oct": 10, "november": 11, "nov": 11,
+    "december": 12, "dec": 12,
+}
+WEEKDAYS = {
+    "monday": 0, "mon": 0, "tuesday": 1, "tues": 1, "tue": 1, "wednesday": 2, "wed": 2,
+    "thursday": 3, "thurs": 3, "thur": 3, "thu": 3, "friday": 4, "fri": 4,
+    "saturday": 5, "sat": 5, "sunday": 6, "sun": 6,
+}
+_MONTH = "(" + "|".join(sorted(MONTHS, key=len, reverse=True)) + r")\.?"
+_WEEKDAY = "(" + "|".join(sorted(WEEKDAYS, key=len, reverse=True)) + r")\.?"
+_ORDINAL = r"(\d{1,2})(?:st|nd|rd|th)?"
+
+# (pattern, kind), every match is resolved and the input is only accepted if they all agree
+DATE_PATTERNS = [
+    (re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b"), "iso"),
+    (re.compile(r"\b(\d{1,2})[/.](\d{1,2})(?:[/.](\d{2}|\d{4}))?\b"), "day_month"),
+    (re.compile(r"\b" + _ORDINAL + r"(?:\s+of)?\s+" + _MONTH + r"(?:,?\s+(\d{4}))?\b"), "day_month_name"),
+    (re.compile(r"\b" + _MONTH + r"\s+" + _ORDINAL + r"(?:,?\s+(\d{4}))?\b"), "month_name_day"),
+    (re.compile(r"\bthe\s+(\d{1,2})(?:st|nd|rd|th)\b"), "day_of_month"),
+    (re.compile(r"\bday after tomorrow\b"), "day_after_tomorrow"),
+    (re.compile(r"\btomorrow\b|\btmr\b|\btmrw\b"), "tomorrow"),
+    (re.compile(r"\btoday\b"), "today"),
+    (re.compile(r"\bin\s+(\d{1,2})\s+days?\b"), "in_days"),
+    (re.compile(r"\b(?:(?:next|this|coming)\s+)?" + _WEEKDAY + r"\b"), "weekday"),
+]
+
+TIME_PATTERN = re.compile(r"^(\d{1,2})(?::(\d{2}))?\s*(am|pm)?$")
+# times inside a longer input need an am/pm, a colon or a leading "at" to be told apart from dates
+TIME_IN_TEXT = re.compile(r"(?:\b(?:at|@)\s*)?\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b|(?:\bat|@)\s*(\d{1,2})(?::(\d{2}))?\b(?![/.]\d)|\b(\d{1,2}):(\d{2})\b")
+TIME_FILLERS = {
+    "at", "around", "about", "please", "ok", "okay", "lets", "let's", "do", "i'll", "ill", "i", "take",
+    "the", "how", "slot", "o'clock", "oclock", "want", "would", "like", "can", "go", "for", "works",
+    "sure", "maybe", "is", "fine", "good", "that", "then", "book", "me", "in",
+}
+
+# words that cannot be part of a name, used to tell "I'm Tommy" from "I'm looking to book"
+NAME_STOPWORDS = {
+    "a", "an", "the", "and", "or", "for", "on", "at", "in", "to", "of", "with", "from", "by", "is", "it",
+    "i", "im", "i'm", "me", "my", "we", "us", "you", "your", "this", "that", "next", "coming",
+    "want", "wanna", "would", "like", "need", "book", "booking", "appointment", "schedule", "please",
+    "looking", "going", "trying", "hoping", "interested", "available", "free", "here", "just", "also",
+    "hi", "hello", "hey", "yes", "no", "ok", "okay", "sure", "thanks", "thank", "sorry", "not",
+    "today", "tomorrow", "day", "date", "time", "week", "month", "morning", "afternoon", "evening",
+    "name", "called", "can", "could", "may", "will", "be", "am", "pm", "after", "before", "around",
+    "good", "fine", "great", "new", "patient", "again", "back", "calling", "booked", "set", "up",
+    "uh", "um", "er", "erm", "well", "so", "oh", "if", "possible", "how", "about", "what", "maybe",
+    "sometime", "whenever", "anytime", "any", "soon", "asap", "earliest", "first", "i'd", "id", "i'll",
+    "busy", "flexible", "thinking", "away", "out", "off", "working", "unavailable", "works", "work",
+} | set(MONTHS) | set(WEEKDAYS)
+# negations, comparisons and exclusions: "not 3pm", "before friday", "I'm busy tomorrow" do not ask for the
+# detail they mention, the LLM has to interpret them
+EXCLUSIONS = {
+    "not", "no", "never", "before", "after", "until", "till", "except", "but", "unless", "instead", "other",
+    "than", "besides", "without", "earlier", "later", "can't", "cant", "cannot", "won't", "wont", "don't",
+    "dont", "isn't", "busy", "away", "unavailable", "working", "work",
+}
+NAME_INTRO = re.compile(r"\b(?:my name is|my name's|name is|name's|i am|i'm|im|this is|it's|its|call me)\s+(.+)")
+NAME_WORD = re.compile(r"^[a-z][a-z'\-]*$")
+# left over after the date and time were taken out, something the LLM has to interpret
+UNRESOLVED = re.compile(r"\d|\btoday\b")
+
+def _normalize(text: str):
+    text = text.lower().replace("’", "'").replace("a.m.", "am").replace("p.m.", "pm")
+    return " ".join(text.split())
+
+def _next_date(month: int, day: int, today: datetime.date, year: int = None):
+    '''
+    The date with the given month and day, the first one strictly after today if no year is given.
+    '''
+    try:
+        if year is not None:
+            return datetime.date(year, month, day)
+        date = datetime.date(today.year, month, day)
+        if date <= today:
+            date = datetime.date(today.year + 1, month, day)
+        return date
+    except ValueError:
+        return None
+
+def _resolve(kind: str, groups: tuple, today: datetime.date):
+    if kind == "iso":
+        return _next_date(int(groups[1]), int(groups[2]), today, int(groups[0]))
+    if kind == "day_month":
+        year = groups[2]
+        if year is not None and len(year) == 2:
+            year = "20" + year
+        return _next_date(int(groups[1]), int(groups[0]), today, int(year) if year else None)
+    if kind == "day_month_name":
+        return _next_date(MONTHS[groups[1]], int(groups[0]), today, int(groups[2]) if groups[2] else None)
+    if kind == "month_name_day":
+        return _next_date(MONTHS[groups[0]], int(groups[1]), today, int(groups[2]) if groups[2] else None)
+    if kind == "day_of_month":
+        day = int(groups[0])
+        month, year = today.month, today.year
+        # this month if the day is still ahead, otherwise the next month that has that day
+        for _ in range(3):
+            try:
+                date = datetime.date(year, month, day)
+                if date > today:
+                    return date
+            except ValueError:
+                pass
+            month, year = (1, year + 1) if month == 12 else (month + 1, year)
+        return None
+    if kind == "today":
+        # bookings start the day after today, the LLM tells the user so
+        return None
+    if kind == "tomorrow":
+        return today + datetime.timedelta(days=1)
+    if kind == "day_after_tomorrow":
+        return today + datetime.timedelta(days=2)
+    if kind == "in_days":
+        return today + datetime.timedelta(days=int(groups[0]))
+    if kind == "weekday":
+        # the first such weekday strictly after today, "next friday" included
+        ahead = (WEEKDAYS[groups[0]] - today.weekday()) % 7 or 7
+        return today + datetime.timedelta(days=ahead)
+    return None
+
+def find_date(text: str, today: datetime.date):
+    '''
+    Returns (date, span) of the date expression in the text, None if there is none or it is ambiguous.
+    '''
+    text = _normalize(text)
+    found = []
+    taken = []
+    for pattern, kind in DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            # skip matches inside an expression already found, e.g. the "6th" of "6th june"
+            if any(start < match.end() and match.start() < end for start, end in taken):
+                continue
+            date = _resolve(kind, match.groups(), today)
+            if date is None:
+                return None
+            found.append((date, match.span()))
+            taken.append(match.span())
+    if not found or len({date for date, _ in found}) > 1:
+        return None
+    return found[0][0].isoformat(), found[0][1]
+
+def parse_time(text: str):
+    '''
+    Hour (0-23) of a 12h or 24h time in the text, None if it cannot be resolved.
+    Without am/pm the time is taken to be within opening hours (9 AM to 5 PM).
+    '''
+    text = _normalize(text)
+    if text in ("noon", "midday", "12 noon"):
+        return 12
+    tokens = [token.strip(",.!?") for token in text.split()]
+    text = " ".join(token for token in tokens if token and token not in TIME_FILLERS)
+    match = TIME_PATTERN.match(text)
+    if match is None:
+        return None
+    return _to_hour(int(match.group(1)), match.group(2), match.group(3))
+
+def find_time(text: str):
+    '''
+    Returns (hour, span) of the time expression in the text, None if there is none or it cannot be resolved.
+    The span indexes the normalized text.
+    '''
+    matches = list(TIME_IN_TEXT.finditer(_normalize(text)))
+    if len(matches) != 1:
+        return None
+    groups = matches[0].groups()
+    if groups[0] is not None:
+        hour = _to_hour(int(groups[0]), groups[1], groups[2])
+    elif groups[3] is not None:
+        hour = _to_hour(int(groups[3]), groups[4], None)
+    else:
+        hour = _to_hour(int(groups[5]), groups[6], None)
+    return (hour, matches[0].span()) if hour is not None else None
+
+def _to_hour(hour: int, minutes: str, suffix: str):
+    # slots are whole hours, leave "2:30" and the like to the LLM
+    if minutes is not None and int(minutes) != 0:
+        return None
+    if suffix == "pm":
+        return hour + 12 if 1 <= hour <= 11 else (12 if hour == 12 else None)
+    if suffix == "am":
+        return 0 if hour == 12 else (hour if 1 <= hour <= 11 else None)
+    if 1 <= hour <= 5:
+        return hour + 12
+    if 9 <= hour <= 23:
+        return hour
+    return None
+
+def _name_from_words(words: list):
+    '''
+    The leading run of name-like words, at most 3.
+    '''
+    name = []
+    for word in words:
+        stripped = word.strip(",.!?;:")
+        if not NAME_WORD.match(stripped.lower()) or stripped.lower() in NAME_STOPWORDS:
+            break
+        name.append(stripped)
+        # punctuation ends the name, "Tommy, next Tuesday"
+        if len(name) == 3 or stripped != word:
+            break
+    return name
+
+def parse_name(text: str):
+    '''
+    Name in the text, None if it cannot be resolved.
+    '''
+    name, rest = _find_name(text)
+    return name if name and not rest else None
+
+def _find_name(text: str, bare: bool = True):
+    '''
+    Returns (name or None, words left over), the words are those that could not be accounted for.
+    bare: accept a name that is not introduced ("my name is ..."), only safe when the text is nothing but the name,
+        next to a date "How about" in "How about Monday" would pass for one
+    '''
+    text = " ".join(text.replace("’", "'").split())
+    lowered = text.lower()
+    intro = NAME_INTRO.search(lowered)
+    if intro:
+        # keep the user's capitalization
+        words = text[intro.start(1):].split()
+        name = _name_from_words(words)
+        # words around the name must be accounted for too, "I'm at work monday" is no name
+        rest = [word.strip(",.!?;:") for word in text[:intro.start()].split() + words[len(name):]]
+        rest = [word for word in rest if word and word.lower() not in NAME_STOPWORDS]
+        return (" ".join(name) if name else None), rest
+    words = [word.strip(",.!?;:") for word in text.split()]
+    words = [word for word in words if word]
+    name = _name_from_words(words) if bare else []
+    rest = [word for word in words[len(name):] if word.lower() not in NAME_STOPWORDS]
+    return (" ".join(name) if name else None), rest
+
+def parse_slots(text: str, today: datetime.date, bare_name: bool = True):
+    '''
+    Every booking detail (name, date, time) found in the text as a dict, None if the text
+    has anything that cannot be accounted for or no detail at all.
+    bare_name: accept a name that is not introduced ("my name is ..."), only safe when a name was asked for,
+        and only taken when the input is nothing but the name
+    '''
+    normalized = _normalize(text)
+    original = " ".join(text.replace("’", "'").split())
+    remaining = original if len(original) == len(normalized) else normalized
+    result = {}
+    spans = []
+    found_time = find_time(text)
+    if found_time is not None:
+        result["time"], span = found_time
+        spans.append(span)
+    found_date = find_date(text, today)
+    if found_date is not None:
+        result["date"], span = found_date
+        if any(start < span[1] and span[0] < end for start, end in spans):
+            return None
+        spans.append(span)
+    for start, end in sorted(spans, reverse=True):
+        remaining = remaining[:start] + " " + remaining[end:]
+    # a number we could not place, e.g. "in 2 weeks", or "today"
+    if UNRESOLVED.search(remaining.lower()):
+        return None
+    if any(word.strip(",.!?;:").lower() in EXCLUSIONS for word in remaining.split()):
+        return None
+    if not bare_name and NAME_INTRO.search(remaining.lower()) is None:
+        # any word left over could be anything, e.g. "sometime" when asked for a date
+        if any(word.strip(",.!?;:").lower() not in NAME_STOPWORDS for word in remaining.split()):
+            return None
+    name, rest = _find_name(remaining, bare=bare_name and not spans)
+    if rest:
+        return None
+    if name is not None:
+        result["name"] = name
+    return result or None
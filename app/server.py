@@ -0,0 +1,256 @@
+'''
+Asyncio HTTP server serving many chat sessions from one process.
+All sessions share one VectorStore and one Bookings store, each session is a Conversation state machine.
+
+POST /chat  {"session": "<id>", "message": "<text>"}  ->  {"session": "<id>", "state": "...", "replies": [...], "usage": {...}}
+    leave out "session" to start a new one, the reply then starts with the greeting
+POST /chat/stream  same request, the response is chunked JSON lines sent as they are ready:
+    {"reply": "<text>"} whole replies, {"delta": "<text>"} chunks of a streamed answer,
+    and a final {"done": true, "session": "<id>", "state": "...", "usage": {...}}
+"usage" holds the RAG prompt and completion tokens of the session so far
+GET /health
+GET /metrics  Prometheus text snapshot of the stage timings and counters, when TRACE=1
+'''
+import asyncio
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from booking import Bookings
+from booking import SqliteStore
+from booking import calendar_from_env
+from conversation import Conversation
+from index import VectorStore
+from metrics import tracer
+
+load_dotenv()
+
+STATUS = {200: "200 OK", 400: "400 Bad Request", 404: "404 Not Found", 405: "405 Method Not Allowed"}
+
+class Session:
+    def __init__(self, conversation: Conversation):
+        self.conversation = conversation
+        # messages of one session are handled in order
+        self.lock = asyncio.Lock()
+        self.last_seen = time.monotonic()
+
+class ChatServer:
+    def __init__(self, bookings: Bookings, store: VectorStore, session_ttl: float = 1800):
+        """
+        bookings, store: shared by all sessions
+        session_ttl: seconds of inactivity after which a session is dropped
+        """
+        self.bookings = bookings
+        self.store = store
+        self.session_ttl = session_ttl
+        self.sessions = {}
+
+    def get_session(self, session_id: str):
+        '''
+        Returns (session id, session, greeting), a new session is started for unknown ids.
+        '''
+        session = self.sessions.get(session_id) if session_id else None
+        greeting = []
+        if session is None:
+            session_id = session_id or uuid.uuid4().hex
+            session = Session(Conversation(self.bookings, self.store))
+            self.sessions[session_id] = session
+            greeting = session.conversation.greeting()
+        session.last_seen = time.monotonic()
+        return session_id, session, greeting
+
+    async def chat(self, session_id: str, message: str):
+        '''
+        Handle one message, the blocking retrieval and LLM calls run on the executor threads.
+        '''
+        session_id, session, replies = self.get_session(session_id)
+        async with session.lock:
+            if message:
+                replies.extend(await asyncio.to_thread(session.conversation.handle, message))
+        conversation = session.conversation
+        return {"session": session_id, "state": conversation.state, "replies": replies, "usage": conversation.usage}
+
+    async def chat_stream(self, writer: asyncio.StreamWriter, session_id: str, message: str):
+        '''
+        Handle one message, writing each event to the chunked response as soon as it is ready.
+        '''
+        session_id, session, greeting = self.get_session(session_id)
+        for reply in greeting:
+            write_chunk(writer, {"reply": reply})
+        await writer.drain()
+        async with session.lock:
+            if message:
+                loop = asyncio.get_running_loop()
+                events = asyncio.Queue()
+
+                def produce():
+                    # runs on an executor thread, hands events back to the event loop
+                    try:
+                        for event in session.conversation.handle_stream(message):
+                            loop.call_soon_threadsafe(events.put_nowait, event)
+                    finally:
+                        loop.call_soon_threadsafe(events.put_nowait, None)
+
+                producer = asyncio.ensure_future(asyncio.to_thread(produce))
+                try:
+                    while (event := await events.get()) is not None:
+                        write_chunk(writer, event)
+                        await writer.drain()
+                finally:
+                    # a client that disconnects mid-answer must not release the session
+                    # while handle_stream is still changing the conversation on its thread
+                    await producer
+        conversation = session.conversation
+        write_chunk(writer, {"done": True, "session": session_id, "state": conversation.state, "usage": conversation.usage})
+        writer.write(b"0\r\n\r\n")
+
+    async def expire_sessions(self, interval: float = 60):
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = time.monotonic() - self.session_ttl
+            for session_id, session in list(self.sessions.items()):
+                if session.last_seen < cutoff and not session.lock.locked():
+                    del self.sessions[session_id]
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # HTTP/1.1 with keep-alive, enough for a local front end or load test
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                if path == "/chat/stream" and method == "POST":
+                    try:
+                        session_id, message = parse_chat_request(body)
+                    except ValueError:
+                        write_response(writer, 400, {"error": "body must be a JSON object"}, keep_alive)
+                    else:
+                        write_stream_head(writer, keep_alive)
+                        await self.chat_stream(writer, session_id, message)
+                else:
+                    status, payload = await self.route(method, path, body)
+                    write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes):
+        if path == "/health":
+            return 200, {"status": "ok", "sessions": len(self.sessions)}
+        if path == "/metrics":
+            return 200, tracer.prometheus()
+        if path != "/chat":
+            return 404, {"error": "not found"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        try:
+            session_id, message = parse_chat_request(body)
+        except ValueError:
+            return 400, {"error": "body must be a JSON object"}
+        return 200, await self.chat(session_id, message)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        expiry = asyncio.create_task(self.expire_sessions())
+        print(f"Chat server listening on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry.cancel()
+
+async def read_request(reader: asyncio.StreamReader):
+    '''
+    Returns (method, path, headers, body), None when the client closed the connection.
+    '''
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode("latin-1").split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+def parse_chat_request(body: bytes):
+    '''
+    Returns (session id, message) from a chat request body, raises ValueError if it is malformed.
+    '''
+    try:
+        data = json.loads(body or b"{}")
+        return data.get("session"), str(data.get("message", ""))
+    except (json.JSONDecodeError, AttributeError) as e:
+        raise ValueError(e)
+
+def write_stream_head(writer: asyncio.StreamWriter, keep_alive: bool = True):
+    head = (
+        f"HTTP/1.1 {STATUS[200]}\r\n"
+        "Content-Type: application/x-ndjson\r\n"
+        "Transfer-Encoding: chunked\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1"))
+
+def write_chunk(writer: asyncio.StreamWriter, event: dict):
+    line = json.dumps(event).encode("utf-8") + b"\n"
+    writer.write(f"{len(line):x}\r\n".encode("latin-1") + line + b"\r\n")
+
+def write_response(writer: asyncio.StreamWriter, status: int, payload, keep_alive: bool = True):
+    '''
+    payload: dict sent as JSON, or str sent as plain text
+    '''
+    if isinstance(payload, str):
+        body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+    else:
+        body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+    head = (
+        f"HTTP/1.1 {STATUS[status]}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+
+async def serve(server: ChatServer, host: str, port: int, threads: int):
+    # sessions wait on the LLM in executor threads, size the pool for the expected concurrency
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=threads))
+    await server.serve(host, port)
+
+def main():
+    bookings_file = "bookings_sample.csv"
+    bookings_db = os.getenv("BOOKINGS_DB")
+    if bookings_db:
+        bookings = Bookings(store=SqliteStore(bookings_db, seed_path=bookings_file), **calendar_from_env())
+    else:
+        bookings = Bookings(bookings_file, journal=True, **calendar_from_env())
+    store = VectorStore("data.jsonl", "faiss_knowledge_base")
+    server = ChatServer(bookings, store)
+    try:
+        asyncio.run(serve(
+            server,
+            os.getenv("CHAT_HOST", "127.0.0.1"),
+            int(os.getenv("CHAT_PORT", "8000")),
+            int(os.getenv("CHAT_THREADS", "256")),
+        ))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bookings.compact()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+'''
+Slot filling for the booking conversation.
+Each user turn is parsed locally, or with one schema-constrained LLM call that returns
+every booking detail it can find, and only the details still missing are asked for.
+'''
+import datetime
+import json
+import threading
+import time
+
+from llm import get_client
+from metrics import incr
+from metrics import span
+from parsing import parse_slots
+from parsing import parse_name
+from parsing import parse_time
+
+SLOTS = ["name", "date", "time"]
+
+SLOT_SCHEMA = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "booking_details",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "name": {"type": ["string", "null"]},
+                "date": {"type": ["string", "null"]},
+                "time": {"type": ["integer", "null"]},
+            },
+            "required": SLOTS,
+            "additionalProperties": False,
+        },
+    },
+}
+
+class BookingSlots:
+    def __init__(self, today: datetime.date):
+        """
+        The details collected so far in one booking conversation, False while missing.
+        today: date relative expressions are resolved against
+        """
+        self.today = today
+        self.name = False
+        self.date = False
+        self.time = False
+        self.turns = 0
+        self.llm_calls = 0
+        self.extract_seconds = 0.0
+        self.started = time.perf_counter()
+
+    def missing(self):
+        return [slot for slot in SLOTS if getattr(self, slot) is False]
+
+class SlotFiller:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.turns = 0
+        self.llm_calls = 0
+        self.bookings = 0
+        self.booking_llm_calls = 0
+        self.booking_turns = 0
+        self.booking_extract_seconds = 0.0
+        self.booking_seconds = 0.0
+
+    def new_booking(self, today: datetime.date):
+        return BookingSlots(today)
+
+    def fill(self, text: str, slots: BookingSlots, expecting: list = None):
+        '''
+        Update slots with the details found in the text, returns the names of the slots that were set.
+        expecting: the slots that were just asked for, a bare "3" is a time when a time was asked for,
+            slots already filled are only changed when asked for again
+        '''
+        start = time.perf_counter()
+        found = self.parse_locally(text, slots.today, expecting)
+        llm_call = found is None
+        if llm_call:
+            found = self.extract(text, slots, expecting)
+        incr("slot_turns", parsed="llm" if llm_call else "local")
+        # only the slots asked for or still missing are filled, "I'm thinking friday" when asked
+        # for the date must not replace the name given earlier
+        found = {slot: value for slot, value in found.items() if slot in (expecting or []) or getattr(slots, slot) is False}
+        for slot, value in found.items():
+            setattr(slots, slot, value)
+
+        slots.turns += 1
+        slots.llm_calls += llm_call
+        slots.extract_seconds += time.perf_counter() - start
+        with self.lock:
+            self.turns += 1
+            self.llm_calls += llm_call
+        return list(found)
+
+    def parse_locally(self, text: str, today: datetime.date, expecting: list = None):
+        if expecting == ["time"]:
+            hour = parse_time(text)
+            if hour is not None:
+                return {"time": hour}
+        if expecting == ["name"]:
+            name = parse_name(text)
+            if name is not None:
+                return {"name": name}
+        return parse_slots(text, today, bare_name=expecting is None or "name" in expecting)
+
+    def extract(self, text: str, slots: BookingSlots, expecting: list = None):
+        '''
+        One schema-constrained LLM call for all booking details in the text.
+        '''
+        today = slots.today
+        asking = ", ".join(expecting or slots.missing()) or "nothing in particular"
+        message = f"""
+                    Given the user's input, extract the details of their appointment booking.
+                    Respond strictly in the following JSON format: {{"name": "name", "date": "YYYY-MM-DD", "time": HH}}
+
+                    - Set any detail that is not in the input, or cannot be confidently determined, to null.
+                    - name: the user's name.
+                    - date: consider that inputs might be in DD/M. If the date is incomplete or relative (e.g. "next Friday"), infer the full date based on today's date: {today} ({today.strftime("%A")}). The derived date must be strictly after {today}.
+                    - time: a number between 0 and 23 (24-hour format, without minutes). If no am or pm is indicated, assume the time falls between 9 AM and 5 PM.
+                    - The user was asked for: {asking}.
+
+                    User input: "{text}"
+                    """
+        try:
+            completion = get_client().complete(
+                store=True,
+                call="slots",
+                response_format=SLOT_SCHEMA,
+                messages = [
+                    {"role": "system", "content": "You are an assistant that extracts structured information from natural language."},
+                    {"role": "user", "content": message},
+                ]
+            )
+            with span("parse_json", call="slot_extract"):
+                response = json.loads(completion.content.strip("```json"))
+        except Exception as e:
+            print("Error in OpenAI API call: ", e)
+            return {}
+        return self.validate(response)
+
+    def validate(self, response: dict):
+        '''
+        Keep only well-formed details from the LLM response.
+        '''
+        found = {}
+        name = response.get("name")
+        if isinstance(name, str) and name.strip() and name.strip().lower() not in ("false", "null", "none"):
+            found["name"] = name.strip()
+        date = response.get("date")
+        try:
+            found["date"] = datetime.datetime.strptime(date, "%Y-%m-%d").date().isoformat()
+        except (TypeError, ValueError):
+            pass
+        hour = response.get("time")
+        try:
+            if hour is not None and hour is not False and 0 <= int(hour) <= 23:
+                found["time"] = int(hour)
+        except (TypeError, ValueError):
+            pass
+        return found
+
+    def complete(self, slots: BookingSlots):
+        '''
+        Record a completed booking conversation.
+        '''
+        with self.lock:
+            self.bookings += 1
+            self.booking_llm_calls += slots.llm_calls
+            self.booking_turns += slots.turns
+            self.booking_extract_seconds += slots.extract_seconds
+            self.booking_seconds += time.perf_counter() - slots.started
+
+    def stats(self):
+        '''
+        Averages per completed booking: LLM calls, turns, seconds spent extracting and total wall-clock seconds.
+        '''
+        bookings = self.bookings or 1
+        return {
+            "bookings": self.bookings,
+            "llm_calls_per_booking": self.booking_llm_calls / bookings,
+            "turns_per_booking": self.booking_turns / bookings,
+            "extract_seconds_per_booking": self.booking_extract_seconds / bookings,
+            "seconds_per_booking": self.booking_seconds / bookings,
+        }